@@ -94,7 +94,337 @@ except MemoryError:
     print("MemoryError caught")
 
 # ----------------------------------------------------------------
-# SECTION 5: Sliding Window View (no copies)
+# SECTION 5: Memory-budgeted chunked evaluation
+# ----------------------------------------------------------------
+"""
+The allocation above is only visible *after* it happened (or after the
+OOM killer fired).  But every intermediate's shape follows from the
+broadcast rules in SECTION 2, so its size can be predicted first:
+
+  exp(-(y[:, None] - x.T)**2)
+
+  y[:, None]          (1000, 1)       view, 0 bytes
+  x.T                 (1000, 10000)   view, 0 bytes
+  (.. - ..)           (1000, 10000)   80 MB  temp #1
+  (..)**2             (1000, 10000)   80 MB  temp #2 (temp #1 still alive)
+  -(..)               (1000, 10000)   80 MB  temp #3 (temp #2 still alive)
+  exp(..)             (1000, 10000)   80 MB  result
+
+  peak = 160 MB of temporaries + the result
+
+If the predicted peak exceeds the budget, the expression is evaluated in
+slabs along one axis (rows, or columns when the rows are reduced).  The
+slab height is the largest one whose predicted peak fits the budget:
+
+   +-----------------+      rows 0..99    -> evaluate -> out[0:100]
+   |#################|      rows 100..199 -> evaluate -> out[100:200]
+   |                 |      ...
+   +-----------------+
+
+Expressions use NumPy syntax on named arrays: + - * / ** comparisons,
+views (names, .T, basic slicing / None) and the functions in
+BUDGET_FUNCTIONS.  A top-level sum/mean/min/max(expr, axis=...) is
+reduced slab by slab, so the full-size intermediate never exists.
+"""
+import ast
+import math
+
+MEMORY_BUDGET = 64 * 2**20   # bytes of temporaries allowed per expression
+
+BUDGET_FUNCTIONS = {
+    "exp": np.exp, "log": np.log, "sqrt": np.sqrt, "abs": np.abs,
+    "sin": np.sin, "cos": np.cos, "tanh": np.tanh,
+    "where": np.where, "maximum": np.maximum, "minimum": np.minimum,
+}
+BUDGET_REDUCTIONS = {"sum": np.sum, "mean": np.mean, "min": np.min, "max": np.max}
+
+
+def _is_basic_index(node):
+    """True for index expressions that produce views: ints, None, slices, ..."""
+    if isinstance(node, ast.Constant):
+        return node.value is None or node.value is Ellipsis or isinstance(node.value, int)
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return _is_basic_index(node.operand)
+    if isinstance(node, ast.Slice):
+        return all(part is None or _is_basic_index(part)
+                   for part in (node.lower, node.upper, node.step))
+    if isinstance(node, ast.Tuple):
+        return all(_is_basic_index(elt) for elt in node.elts)
+    return False
+
+
+def _is_view(node):
+    """True for sub-expressions that NumPy evaluates as views (no allocation)."""
+    if isinstance(node, ast.Name):
+        return node.id not in BUDGET_FUNCTIONS
+    if isinstance(node, ast.Attribute):
+        return node.attr == "T" and _is_view(node.value)
+    if isinstance(node, ast.Subscript):
+        return _is_view(node.value) and _is_basic_index(node.slice)
+    return False
+
+
+class _ExtractViews(ast.NodeTransformer):
+    """Replaces every view sub-expression by a placeholder name (_v0, _v1, ...)."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.views = {}
+
+    def visit(self, node):
+        if _is_view(node):
+            value = eval(compile(ast.Expression(node), "<expr>", "eval"),
+                         {"__builtins__": {}}, dict(self.arrays))
+            name = f"_v{len(self.views)}"
+            self.views[name] = np.asarray(value)
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            raise ValueError(f"Unsupported sub-expression {ast.unparse(node)!r}: "
+                             f"only views of named arrays can be indexed")
+        return self.generic_visit(node)
+
+
+def _analyze(node, shapes, itemsizes, count_result=True):
+    """
+    Returns (shape, result_bytes, peak_temp_bytes) for an expression node.
+
+    Temporaries of the operands stay alive until the parent's result has
+    been allocated, which is what NumPy does for `a + b`.  `itemsizes` maps
+    every operation node to the itemsize of its own result (see `_prepare`).
+    """
+    if isinstance(node, ast.Name):
+        return shapes[node.id], 0, 0
+    if isinstance(node, ast.Constant):
+        return (), 0, 0
+    if isinstance(node, ast.BinOp):
+        operands = [node.left, node.right]
+    elif isinstance(node, ast.UnaryOp):
+        operands = [node.operand]
+    elif isinstance(node, ast.Compare) and len(node.comparators) == 1:
+        operands = [node.left, node.comparators[0]]
+    elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+          and node.func.id in BUDGET_FUNCTIONS and not node.keywords):
+        operands = node.args
+    else:
+        raise ValueError(f"Unsupported expression {ast.unparse(node)!r}")
+
+    held = 0
+    peak = 0
+    operand_shapes = []
+    for operand in operands:
+        shape, nbytes, operand_peak = _analyze(operand, shapes, itemsizes)
+        peak = max(peak, held + operand_peak)
+        held += nbytes
+        operand_shapes.append(shape)
+    shape = np.broadcast_shapes(*operand_shapes)
+    nbytes = math.prod(shape) * itemsizes[node]
+    peak = max(peak, held + (nbytes if count_result else 0))
+    return shape, nbytes, peak
+
+
+def _split_reduction(tree):
+    """Splits `sum(expr, axis=k)` into ("sum", k, expr); plain exprs give (None, None, expr)."""
+    node = tree.body
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+            and node.func.id in BUDGET_REDUCTIONS and len(node.args) == 1):
+        axis = None
+        for keyword in node.keywords:
+            if keyword.arg != "axis":
+                raise ValueError(f"Unsupported keyword {keyword.arg!r} in {node.func.id}()")
+            axis = ast.literal_eval(keyword.value)
+        return node.func.id, axis, node.args[0]
+    return None, None, node
+
+
+def _prepare(expr, arrays):
+    reduction, axis, inner = _split_reduction(ast.parse(expr, mode="eval"))
+    extractor = _ExtractViews(arrays)
+    inner = ast.fix_missing_locations(extractor.visit(inner))
+    views = extractor.views
+    # Probe the dtype of every operation on one element of every view:
+    # `(x - y) > 0` allocates a float64 temporary for a bool result.
+    probe_ns = dict(BUDGET_FUNCTIONS)
+    probe_ns.update({name: v[(slice(0, 1),) * v.ndim] for name, v in views.items()})
+    itemsizes = {}
+    for node in ast.walk(inner):
+        if isinstance(node, (ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call)):
+            probe = eval(compile(ast.Expression(node), "<expr>", "eval"),
+                         {"__builtins__": {}}, probe_ns)
+            itemsizes[node] = np.asarray(probe).dtype.itemsize
+    code = compile(ast.Expression(inner), "<expr>", "eval")
+    dtype = np.asarray(eval(code, {"__builtins__": {}}, probe_ns)).dtype
+    return reduction, axis, inner, code, views, dtype, itemsizes
+
+
+def _peak_for(inner, views, itemsizes, reduction, chunk_axis=None, chunk=None,
+              into_out=False):
+    ndim = len(np.broadcast_shapes(*(v.shape for v in views.values())))
+    shapes = {}
+    for name, v in views.items():
+        shape = list(v.shape)
+        if chunk_axis is not None:
+            axis = chunk_axis - (ndim - v.ndim)
+            if axis >= 0 and shape[axis] != 1:
+                shape[axis] = chunk
+        shapes[name] = tuple(shape)
+    # A plain expression's result is the output itself; a reduction's input,
+    # any slab result, and a result that is then copied into `out` are
+    # temporaries.
+    count_result = reduction is not None or chunk_axis is not None or into_out
+    shape, _, peak = _analyze(inner, shapes, itemsizes, count_result=count_result)
+    return shape, peak
+
+
+def predict_peak_memory(expr, **arrays):
+    """
+    Predicts the peak bytes of temporaries NumPy allocates for `expr`.
+
+    Returns:
+        (peak_bytes, shape of the full elementwise result)
+    """
+    reduction, _, inner, _, views, _, itemsizes = _prepare(expr, arrays)
+    shape, peak = _peak_for(inner, views, itemsizes, reduction)
+    return peak, shape
+
+
+def evaluate_within_budget(expr, budget=None, out=None, **arrays):
+    """
+    Evaluates `expr`, chunking it so temporaries stay within `budget` bytes.
+
+    Args:
+        expr: Expression over the named arrays, optionally wrapped in a
+            top-level sum/mean/min/max(..., axis=k).
+        budget: Byte budget for temporaries (default: MEMORY_BUDGET).
+        out: Optional preallocated output (e.g. an np.memmap).
+        **arrays: The named input arrays.
+
+    Returns:
+        The result array (`out` if given).
+    """
+    budget = MEMORY_BUDGET if budget is None else budget
+    reduction, axis, inner, code, views, dtype, itemsizes = _prepare(expr, arrays)
+    into_out = out is not None
+    shape, peak = _peak_for(inner, views, itemsizes, reduction, into_out=into_out)
+    ndim = len(shape)
+    if axis is not None:
+        axis = axis % ndim
+    reduce_fn = BUDGET_REDUCTIONS.get(reduction)
+    namespace = dict(BUDGET_FUNCTIONS)
+
+    if peak <= budget:
+        namespace.update(views)
+        result = eval(code, {"__builtins__": {}}, namespace)
+        if reduce_fn is not None:
+            result = reduce_fn(result, axis=axis)
+        if out is None:
+            return np.asarray(result)
+        out[...] = result
+        return out
+
+    # Slab axis: rows, unless the rows are what is being reduced.
+    chunk_axis = 1 if (axis == 0 and ndim > 1) else 0
+    extent = shape[chunk_axis] if ndim else 1
+    low, high = 0, extent
+    while low < high:  # largest slab whose predicted peak fits the budget
+        mid = (low + high + 1) // 2
+        if _peak_for(inner, views, itemsizes, reduction, chunk_axis, mid, into_out)[1] <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    chunk = low
+    if chunk == 0:
+        raise MemoryError(f"{expr!r} needs more than {budget} bytes of temporaries "
+                          f"even for a single slab along axis {chunk_axis}")
+
+    # Reducing everything, or the slab axis itself (a 1-D input): combine
+    # the reductions of the slabs.
+    if reduce_fn is not None and (axis is None or axis == chunk_axis):
+        partials = []
+        for start in range(0, extent, chunk):
+            slab = _eval_slab(code, namespace, views, ndim, chunk_axis, start, start + chunk)
+            partials.append(np.sum(slab) if reduction == "mean" else reduce_fn(slab))
+            del slab  # release this slab before the next one is allocated
+        total = (np.sum if reduction in ("sum", "mean") else reduce_fn)(partials)
+        if reduction == "mean":
+            total = total / math.prod(shape)
+        if out is None:
+            return np.asarray(total)
+        out[...] = total
+        return out
+
+    if out is None:
+        out_shape = shape if reduce_fn is None else shape[:axis] + shape[axis + 1:]
+        probe = np.empty((1,) * ndim, dtype=dtype)
+        out_dtype = dtype if reduce_fn is None else reduce_fn(probe, axis=axis).dtype
+        out = np.empty(out_shape, dtype=out_dtype)
+    out_axis = chunk_axis if (axis is None or chunk_axis < axis) else chunk_axis - 1
+    for start in range(0, extent, chunk):
+        slab = _eval_slab(code, namespace, views, ndim, chunk_axis, start, start + chunk)
+        if reduce_fn is not None:
+            slab = reduce_fn(slab, axis=axis)
+        index = [slice(None)] * out.ndim
+        index[out_axis] = slice(start, start + chunk)
+        out[tuple(index)] = slab
+        del slab
+    return out
+
+
+def _eval_slab(code, namespace, views, ndim, chunk_axis, start, stop):
+    """Evaluates the expression on rows/columns [start, stop) of every view."""
+    slab_ns = dict(namespace)
+    for name, v in views.items():
+        axis = chunk_axis - (ndim - v.ndim)
+        if axis >= 0 and v.shape[axis] != 1:
+            index = [slice(None)] * v.ndim
+            index[axis] = slice(start, stop)
+            v = v[tuple(index)]
+        slab_ns[name] = v
+    return eval(code, {"__builtins__": {}}, slab_ns)
+
+
+print("\n=== Memory-Budgeted Evaluation ===")
+expr = "exp(-(y[:, None] - x.T)**2)"
+peak, shape = predict_peak_memory(expr, x=x, y=y)
+print(f"{expr}: result {shape}, predicted temporaries {peak / 1e6:.0f} MB")
+
+budget = 8 * 2**20
+reduced = evaluate_within_budget(f"sum({expr}, axis=1)", budget=budget, x=x, y=y)
+peak, _ = predict_peak_memory(f"sum({expr}, axis=1)", x=x, y=y)
+print(f"sum(..., axis=1) with an {budget // 2**20} MB budget instead of "
+      f"{peak / 1e6:.0f} MB -> shape {reduced.shape}")
+assert np.allclose(reduced[:10], np.exp(-(y[:10, None] - x.T[:10])**2).sum(axis=1))
+
+# Into a memmap: the full result would be built in RAM and then copied, so
+# it counts against the budget and the expression is evaluated in slabs.
+import tempfile, tracemalloc
+col, row = np.arange(2000.0)[:, None], np.arange(2000.0)[None, :]
+with tempfile.TemporaryFile() as f:
+    out = np.memmap(f, dtype=np.float64, mode="w+", shape=(2000, 2000))
+    tracemalloc.start()
+    evaluate_within_budget("col + row", budget=2**20, out=out, col=col, row=row)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"col + row into a {out.nbytes / 1e6:.0f} MB memmap, 1 MB budget: "
+          f"traced peak {traced_peak / 1e6:.1f} MB")
+    assert traced_peak < 2 * 2**20 and out[123, 456] == 579
+    del out
+
+# Every temporary is sized with its own dtype: the result of `(x - y) > 0`
+# is bool (1 byte per element), but `x - y` is a full float64 array.
+peak, shape = predict_peak_memory("(col - row) > 0", col=col, row=row)
+print(f"(col - row) > 0: result {shape}, predicted temporaries {peak / 1e6:.0f} MB")
+assert peak == 2000 * 2000 * 8
+mask = evaluate_within_budget("(col - row) > 0", budget=2**20, col=col, row=row)
+assert mask.dtype == np.bool_ and mask.sum() == 2000 * 1999 // 2
+
+# A 1-D reduction over budget reduces slab by slab and combines the results
+a = np.random.rand(10**6)
+total = evaluate_within_budget("sum(exp(a)*2, axis=0)", budget=2**20, a=a)
+assert np.isclose(total, np.sum(np.exp(a) * 2))
+assert np.isclose(evaluate_within_budget("mean(a*2, axis=0)", budget=2**20, a=a),
+                  np.mean(a * 2))
+
+# ----------------------------------------------------------------
+# SECTION 6: Sliding Window View (no copies)
 # ----------------------------------------------------------------
 """
 Use case: extract all 3x3 blocks from a 5x5 image
@@ -17,9 +17,15 @@ It focuses on using Numba and Numexpr to accelerate CPU-bound tasks.
 
 import numpy as np
 import time
-from numba import jit, njit, prange, set_num_threads  # Import Numba decorators and functions
+from numba import jit, njit, prange, set_num_threads, get_num_threads  # Import Numba decorators and functions
+import numba
 import numexpr as ne  # Import Numexpr
 import os
+import ast
+import json
+import math
+import functools
+import tempfile
 
 # -----------------------------------------------------------------------------
 # Loop Unrolling
@@ -188,23 +194,245 @@ def demonstrate_numba(x, y):
 # further improve performance on multi-core CPUs.
 #
 # Example: Numba with parallelization
+@jit(nopython=True, parallel=True)
+def numba_parallel_loop(x, y):
+    result = np.zeros_like(x)
+    for i in prange(len(x)):  # Use prange instead of range for parallelization
+        result[i] = x[i] + y[i]
+    return result
+
+# The add above is memory-bound: past two or three threads the memory bus is
+# saturated and extra threads only add scheduling overhead.  The challenge
+# formula does enough arithmetic per element to keep every core busy, so the
+# two kernels usually want very different thread counts.
+@jit(nopython=True, parallel=True)
+def numba_parallel_challenge(x, y):
+    result = np.empty_like(x)
+    for i in prange(len(x)):
+        result[i] = np.exp(-(x[i] - y[i])**2) / (1 + (x[i] + y[i])**2)
+    return result
+
+# -----------------------------------------------------------------------------
+# Choosing the Thread Count: CPU Quotas and Autotuning
+# -----------------------------------------------------------------------------
+#
+# `os.cpu_count()` reports the CPUs of the *host*.  Inside a container it
+# ignores both the CPU affinity mask (`docker run --cpuset-cpus`) and the CFS
+# quota (`docker run --cpus=2`, Kubernetes `limits.cpu`).  Starting 64 threads
+# under a 2-CPU quota makes the kernel throttle the whole process for the
+# rest of every scheduling period, which is far slower than using 2 threads.
+#
+# `available_cpu_count()` takes the minimum of:
+#
+# -   the affinity mask (`os.sched_getaffinity`),
+# -   the cgroup v2 quota (`/sys/fs/cgroup/cpu.max`, "quota period"),
+# -   the cgroup v1 quota (`cpu.cfs_quota_us / cpu.cfs_period_us`),
+# -   the size of Numba's thread pool (`numba.config.NUMBA_NUM_THREADS`),
+#     which `set_num_threads` can never exceed.
+#
+# Even within the quota, "more threads" is not always faster (see the
+# memory-bound add above), so `autotune_threads()` measures each kernel at
+# each thread count and array-size bucket (powers of ten) and stores the
+# winner in a JSON file.  `run_tuned()` then looks the setting up on every
+# call; re-tuning only happens when the file is missing, the kernel/bucket is
+# new, or the available CPU count changed.
+#
+# A lookup has to cost far less than the kernel it wraps, so the CPU count is
+# computed once per process and each tuning file is read once and then kept
+# in memory; the file is only written again when a new entry is tuned.  The
+# default file lives in the temp directory, not in the user's home.
+#
+THREAD_TUNING_FILE = os.path.join(tempfile.gettempdir(), "numba_thread_tuning.json")
+
+_thread_tunings = {}  # path -> tuning table loaded from (or saved to) it
+
+
+def _cgroup_cpu_limit():
+    """Returns the CPU limit imposed by a cgroup quota, or None if unlimited."""
+    try:  # cgroup v2
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:  # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def available_cpu_count():
+    """
+    Returns the number of threads it makes sense to run in this process.
+
+    Unlike `os.cpu_count()`, this respects the CPU affinity mask, cgroup v1/v2
+    CPU quotas and the size of Numba's thread pool.  The result is computed
+    once per process.
+    """
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on Windows/macOS
+        count = os.cpu_count() or 1
+    limit = _cgroup_cpu_limit()
+    if limit is not None:
+        count = min(count, max(1, math.ceil(limit)))
+    return max(1, min(count, numba.config.NUMBA_NUM_THREADS))
+
+
+def size_bucket(size):
+    """Maps an array size to its power-of-ten bucket (e.g. 350_000 -> 100_000)."""
+    return 10 ** int(math.log10(max(size, 1)))
+
+
+def _candidate_thread_counts(max_threads):
+    """1, 2, 4, ... up to and including `max_threads`."""
+    counts = []
+    n = 1
+    while n < max_threads:
+        counts.append(n)
+        n *= 2
+    counts.append(max_threads)
+    return counts
+
+
+def load_thread_tuning(path=THREAD_TUNING_FILE):
+    """
+    Loads the persisted tuning table, or an empty one for a new machine.
+
+    The file is read on the first call for `path` only; later calls return
+    the table kept in memory.
+    """
+    table = _thread_tunings.get(path)
+    if table is not None:
+        return table
+    try:
+        with open(path) as f:
+            table = json.load(f)
+    except (OSError, ValueError):
+        table = None
+    if table is None or table.get("cpus") != available_cpu_count():
+        # New file, or a different quota/host: old measurements no longer apply.
+        table = {"cpus": available_cpu_count(), "kernels": {}}
+    _thread_tunings[path] = table
+    return table
+
+
+def save_thread_tuning(table, path=THREAD_TUNING_FILE):
+    """Writes the tuning table atomically (write to temp file, then rename)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(table, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+    _thread_tunings[path] = table
+
+
+def autotune_threads(kernel, make_args, sizes=(10_000, 100_000, 1_000_000, 10_000_000),
+                     name=None, repeats=3, path=THREAD_TUNING_FILE):
+    """
+    Measures a parallel Numba kernel across thread counts and array sizes.
+
+    Args:
+        kernel: A `@jit(parallel=True)` function.
+        make_args: Callable `make_args(size) -> tuple` building the kernel inputs.
+        sizes: Array sizes to measure; each is stored under its size bucket.
+        name: Key used in the tuning file (defaults to the kernel's name).
+        repeats: Number of timed runs per setting; the best time is kept.
+        path: The JSON file the results are persisted to.
+
+    Returns:
+        {size bucket: best thread count} for this kernel.
+    """
+    name = name or kernel.__name__
+    table = load_thread_tuning(path)
+    previous_threads = get_num_threads()
+    best_threads = {}
+    try:
+        for size in sizes:
+            args = make_args(size)
+            kernel(*args)  # compile outside the timed region
+            timings = {}
+            for threads in _candidate_thread_counts(available_cpu_count()):
+                set_num_threads(threads)
+                best = float("inf")
+                for _ in range(repeats):
+                    start_time = time.perf_counter()
+                    kernel(*args)
+                    best = min(best, time.perf_counter() - start_time)
+                timings[threads] = best
+            best_threads[str(size_bucket(size))] = min(timings, key=timings.get)
+    finally:
+        set_num_threads(previous_threads)
+    table["kernels"].setdefault(name, {}).update(best_threads)
+    save_thread_tuning(table, path)
+    return {int(bucket): threads for bucket, threads in best_threads.items()}
+
+
+def tuned_thread_count(name, size, path=THREAD_TUNING_FILE):
+    """
+    Returns the tuned thread count for `name` at `size`, or None if untuned.
+
+    Sizes between measured buckets use the nearest smaller measured bucket.
+    """
+    buckets = load_thread_tuning(path)["kernels"].get(name)
+    if not buckets:
+        return None
+    measured = sorted(int(b) for b in buckets)
+    chosen = measured[0]
+    for bucket in measured:
+        if bucket <= size:
+            chosen = bucket
+    return buckets[str(chosen)]
+
+
+def run_tuned(kernel, *args, size=None, name=None, path=THREAD_TUNING_FILE):
+    """
+    Calls `kernel(*args)` with its tuned thread count.
+
+    Falls back to `available_cpu_count()` threads when the kernel has not
+    been tuned yet.  The previous Numba thread count is restored afterwards.
+    """
+    name = name or kernel.__name__
+    if size is None:
+        size = len(args[0])
+    max_threads = available_cpu_count()
+    threads = tuned_thread_count(name, size, path) or max_threads
+    previous_threads = get_num_threads()
+    set_num_threads(min(threads, max_threads))
+    try:
+        return kernel(*args)
+    finally:
+        set_num_threads(previous_threads)
+
+
 def demonstrate_numba_parallel(x, y):
-    # Use the number of available CPU cores, but cap it at 2 (as per the error message)
-    num_threads = min(os.cpu_count(), 2)
-    set_num_threads(num_threads)
-    print(f"Using {num_threads} threads for Numba parallel execution.")
+    # os.cpu_count() overreports inside containers; use the quota-aware count.
+    num_threads = available_cpu_count()
+    print(f"os.cpu_count() = {os.cpu_count()}, available for Numba = {num_threads}")
 
-    @jit(nopython=True, parallel=True)
-    def numba_parallel_loop(x, y):
-        result = np.zeros_like(x)
-        for i in prange(len(x)):  # Use prange instead of range for parallelization
-            result[i] = x[i] + y[i]
-        return result
+    def make_args(size):
+        return np.random.rand(size), np.random.rand(size)
+
+    for kernel in (numba_parallel_loop, numba_parallel_challenge):
+        if tuned_thread_count(kernel.__name__, len(x)) is None:
+            tuning = autotune_threads(kernel, make_args, sizes=(10_000, 100_000, len(x)))
+            print(f"Tuned {kernel.__name__}: {tuning} (size bucket -> threads)")
 
+    numba_parallel_loop(x, y)  # compile outside the timed region
     start_time = time.time()
-    result_numba_parallel = numba_parallel_loop(x, y)
+    result_numba_parallel = run_tuned(numba_parallel_loop, x, y)
     numba_parallel_time = time.time() - start_time
+    print(f"Using {tuned_thread_count('numba_parallel_loop', len(x))} threads "
+          f"for Numba parallel execution.")
     print(f"Numba parallel time: {numba_parallel_time:.4f} seconds")
+    np.testing.assert_allclose(result_numba_parallel, x + y)
 
     return numba_parallel_time
 # -----------------------------------------------------------------------------
@@ -412,11 +640,450 @@ def optimized_computation_numba(x, y):
             result[i, j] = np.exp(-(x[i, j] - y[i, j])**2) / (1 + (x[i, j] + y[i, j])**2)
     return result
 
+# -----------------------------------------------------------------------------
+# One Expression, Three Backends: A Selectable Expression Engine
+# -----------------------------------------------------------------------------
+#
+# The challenge above implements the same formula twice: once as a Numexpr
+# string and once as a hand-written Numba loop.  The two versions have no
+# common interface, so every new expression has to be written (and kept in
+# sync) once per backend.
+#
+# `evaluate()` takes a single Numexpr-style expression string and routes it to
+# one of three backends:
+#
+# -   "numpy":   the string is evaluated with NumPy ufuncs (one temporary array
+#                per operation, single-threaded).
+# -   "numexpr": the string is handed to `ne.evaluate` unchanged.
+# -   "numba":   a flat `prange` kernel is generated from the string, compiled
+#                once per (expression, dtypes) signature and cached.
+# -   "auto":    the backend is chosen from a one-time calibration that measures
+#                the throughput (elements per second) of every backend at a few
+#                array sizes on *this* machine.  The small-array winner is
+#                usually NumPy (no dispatch/thread overhead), the large-array
+#                winner is usually Numexpr or Numba.
+#
+# Calibration also cross-checks every backend against the NumPy reference; a
+# backend that disagrees is never selected.  `cross_check_backends()` runs the
+# same comparison for an arbitrary expression and input.
+#
+# The result dtype is NumPy's, whatever the backend: Numexpr and the Numba
+# kernel promote a Python scalar like an array (`float32 * 2.5` gives
+# float64), NumPy keeps the array's dtype (float32).  Their results are cast
+# to the dtype of a one-element NumPy probe, so "auto" cannot change the
+# dtype with the input size.
+#
+ENGINE_BACKENDS = ("numpy", "numexpr", "numba")
+
+# Functions that may appear in an expression, mapped to their NumPy ufuncs.
+# The names follow Numexpr's function set, so every expression is valid for
+# all three backends.
+_ENGINE_FUNCTIONS = {
+    "exp": np.exp, "expm1": np.expm1, "log": np.log, "log1p": np.log1p,
+    "log10": np.log10, "sqrt": np.sqrt, "abs": np.abs,
+    "sin": np.sin, "cos": np.cos, "tan": np.tan,
+    "arcsin": np.arcsin, "arccos": np.arccos, "arctan": np.arctan,
+    "arctan2": np.arctan2, "sinh": np.sinh, "cosh": np.cosh, "tanh": np.tanh,
+    "where": np.where,
+}
+
+_NUMBA_KERNELS = {}        # (expression, dtypes) -> compiled kernel
+_ENGINE_CALIBRATION = {}   # array size -> {backend: elements per second}
+
+
+def _expression_variables(expr):
+    """Returns the sorted variable names used in an expression string."""
+    tree = ast.parse(expr, mode="eval")
+    names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+    return sorted(names - set(_ENGINE_FUNCTIONS))
+
+
+def _evaluate_numpy(expr, arrays):
+    namespace = dict(_ENGINE_FUNCTIONS)
+    namespace.update(arrays)
+    return eval(expr, {"__builtins__": {}}, namespace)
+
+
+def _result_dtype(expr, arrays):
+    """The dtype NumPy gives `expr`, probed on one element of every array.
+       Scalars are passed as they are, so NumPy's promotion rules for Python
+       scalars apply.
+    """
+    probe = {name: a.reshape(-1)[:1] if isinstance(a, np.ndarray) and a.ndim else a
+             for name, a in arrays.items()}
+    return np.asarray(_evaluate_numpy(expr, probe)).dtype
+
+
+def _evaluate_numexpr(expr, arrays):
+    result = ne.evaluate(expr, local_dict=arrays)
+    return result.astype(_result_dtype(expr, arrays), copy=False)
+
+
+def _numba_kernel(expr, names, dtypes):
+    """
+    Generates, compiles and caches a flat parallel Numba kernel for `expr`.
+
+    The generated source for "exp(-(x - y)**2)" looks like:
+
+        def kernel(out, x, y):
+            for i in prange(out.shape[0]):
+                out[i] = exp(-(x[i] - y[i])**2)
+    """
+    key = (expr, dtypes)
+    kernel = _NUMBA_KERNELS.get(key)
+    if kernel is not None:
+        return kernel
+
+    class _IndexNames(ast.NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in names:
+                return ast.Subscript(value=node, slice=ast.Name(id="i", ctx=ast.Load()),
+                                     ctx=ast.Load())
+            return node
+
+    body = ast.unparse(_IndexNames().visit(ast.parse(expr, mode="eval")))
+    source = (
+        f"def kernel(out, {', '.join(names)}):\n"
+        f"    for i in prange(out.shape[0]):\n"
+        f"        out[i] = {body}\n"
+    )
+    namespace = {"prange": prange}
+    namespace.update(_ENGINE_FUNCTIONS)
+    exec(source, namespace)
+    kernel = njit(parallel=True)(namespace["kernel"])
+    _NUMBA_KERNELS[key] = kernel
+    return kernel
+
+
+def _evaluate_numba(expr, arrays):
+    names = _expression_variables(expr)
+    operands = [np.asarray(arrays[name]) for name in names]
+    shape = np.broadcast_shapes(*(a.shape for a in operands))
+    # The kernel works on flat, contiguous buffers; operands that already have
+    # the full shape are passed through without a copy.
+    flat = [np.ascontiguousarray(np.broadcast_to(a, shape)).reshape(-1) for a in operands]
+    # NumPy's type promotion decides the output dtype; the kernel's values
+    # are cast to it when they are stored.
+    out = np.empty(math.prod(shape), dtype=_result_dtype(expr, arrays))
+    kernel = _numba_kernel(expr, tuple(names), tuple(a.dtype.str for a in flat))
+    kernel(out, *flat)
+    return out.reshape(shape)
+
+
+_ENGINE_DISPATCH = {
+    "numpy": _evaluate_numpy,
+    "numexpr": _evaluate_numexpr,
+    "numba": _evaluate_numba,
+}
+
+
+def cross_check_backends(expr, rtol=1e-7, atol=0.0, **arrays):
+    """
+    Evaluates `expr` with every backend and compares against the NumPy result.
+
+    Args:
+        expr: A Numexpr-style expression string, e.g. "x + y * z".
+        rtol, atol: Tolerances passed to `np.allclose`.
+        **arrays: The arrays (or scalars) referenced by the expression.
+
+    Returns:
+        A dict mapping backend name to True if it matches the NumPy reference
+        in dtype and (within the tolerances) in value.
+    """
+    reference = np.asarray(_evaluate_numpy(expr, arrays))
+    agreement = {"numpy": True}
+    for backend in ENGINE_BACKENDS[1:]:
+        try:
+            result = np.asarray(_ENGINE_DISPATCH[backend](expr, arrays))
+            if result.dtype != reference.dtype:
+                print(f"Backend {backend} returned {result.dtype} instead of "
+                      f"{reference.dtype} on {expr!r}")
+                agreement[backend] = False
+                continue
+            agreement[backend] = bool(np.allclose(result, reference, rtol=rtol, atol=atol))
+        except Exception as e:
+            print(f"Backend {backend} failed on {expr!r}: {e}")
+            agreement[backend] = False
+    return agreement
+
+
+def calibrate_engine(expr="exp(-(x - y)**2) / (1 + (x + y)**2)",
+                     sizes=(1_000, 10_000, 100_000, 1_000_000), repeats=3):
+    """
+    Measures the throughput of every backend at several array sizes.
+
+    Each backend is warmed up first (so Numba compile time is excluded), then
+    timed `repeats` times per size; the best time is kept.  Backends whose
+    result does not match the NumPy reference are recorded with a throughput
+    of 0 so `auto` never picks them.
+
+    Args:
+        expr: The expression used for calibration.
+        sizes: The array sizes (number of elements) to measure.
+        repeats: Number of timed runs per backend and size.
+
+    Returns:
+        The calibration table: {size: {backend: elements per second}}.
+    """
+    _ENGINE_CALIBRATION.clear()
+    names = _expression_variables(expr)
+    for size in sizes:
+        arrays = {name: np.random.rand(size) for name in names}
+        agreement = cross_check_backends(expr, **arrays)  # also warms up Numba
+        throughput = {}
+        for backend in ENGINE_BACKENDS:
+            if not agreement[backend]:
+                throughput[backend] = 0.0
+                continue
+            best = float("inf")
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                _ENGINE_DISPATCH[backend](expr, arrays)
+                best = min(best, time.perf_counter() - start_time)
+            throughput[backend] = size / max(best, 1e-9)
+        _ENGINE_CALIBRATION[size] = throughput
+    return dict(_ENGINE_CALIBRATION)
+
+
+def select_backend(size):
+    """
+    Returns the backend with the best calibrated throughput for `size` elements.
+
+    The calibration bucket used is the largest calibrated size that does not
+    exceed `size` (or the smallest bucket for tiny inputs).  Calibration runs
+    once, on first use.
+    """
+    if not _ENGINE_CALIBRATION:
+        calibrate_engine()
+    buckets = sorted(_ENGINE_CALIBRATION)
+    bucket = buckets[0]
+    for candidate in buckets:
+        if candidate <= size:
+            bucket = candidate
+    throughput = _ENGINE_CALIBRATION[bucket]
+    return max(throughput, key=throughput.get)
+
+
+def evaluate(expr, backend="auto", **arrays):
+    """
+    Evaluates an elementwise expression with the chosen backend.
+
+    Args:
+        expr: A Numexpr-style expression string, e.g.
+            "exp(-(x - y)**2) / (1 + (x + y)**2)".
+        backend: "numpy", "numexpr", "numba" or "auto".
+        **arrays: The arrays (or scalars) referenced by the expression.
+
+    Returns:
+        A NumPy array with the broadcast shape of the inputs.
+    """
+    missing = [name for name in _expression_variables(expr) if name not in arrays]
+    if missing:
+        raise ValueError(f"Expression {expr!r} references undefined names: {missing}")
+    if backend == "auto":
+        size = max((np.size(a) for a in arrays.values()), default=1)
+        backend = select_backend(size)
+    if backend not in _ENGINE_DISPATCH:
+        raise ValueError(f"Unknown backend {backend!r}; expected one of {ENGINE_BACKENDS} or 'auto'")
+    return _ENGINE_DISPATCH[backend](expr, arrays)
+
+
+# Example: the challenge expression through the engine
+def demonstrate_expression_engine(x, y):
+    expr = "exp(-(x - y)**2) / (1 + (x + y)**2)"
+    calibration = calibrate_engine(expr)
+    for size, throughput in calibration.items():
+        ranking = ", ".join(f"{b}={t / 1e6:.1f}M/s" for b, t in throughput.items())
+        print(f"  size {size:>9,}: {ranking} -> {select_backend(size)}")
+
+    print("Cross-check:", cross_check_backends(expr, x=x, y=y))
+    for backend in ENGINE_BACKENDS + ("auto",):
+        start_time = time.time()
+        result = evaluate(expr, backend=backend, x=x, y=y)
+        print(f"evaluate(backend={backend!r}) time: {time.time() - start_time:.4f} seconds")
+    np.testing.assert_allclose(result, optimized_computation_numexpr(x, y), rtol=1e-7)
+
+    # Python scalars follow NumPy's promotion on every backend: float32 stays float32
+    x32 = x.astype(np.float32)
+    assert all(cross_check_backends("x * a", rtol=1e-6, x=x32, a=2.5).values())
+    for backend in ENGINE_BACKENDS:
+        assert evaluate("x * a", backend=backend, x=x32, a=2.5).dtype == np.float32
+    return result
+
+# -----------------------------------------------------------------------------
+# Generating Unrolled and Specialized Kernels
+# -----------------------------------------------------------------------------
+#
+# `demonstrate_loop_unrolling` unrolls its loop by hand, and whether unrolling
+# pays off depends on the compiler, the CPU and the loop body.  Instead of
+# guessing, `specialize_kernel()` takes a *scalar* kernel such as
+#
+#     def saxpy(x, y):
+#         return 2.0 * x + y
+#
+# and generates a family of elementwise loops around it:
+#
+# -   unrolled by each factor in `factors` (1 = plain loop), with a remainder
+#     loop for the last `n % factor` elements;
+# -   type-specialized: each variant is compiled eagerly for the dtypes of the
+#     sample arguments, so there is no dispatch or type inference per call;
+# -   contiguous-only (`float64[::1]`) or any-layout (`float64[:]`).  The
+#     contiguous signature lets LLVM assume unit stride and vectorize with
+#     SIMD; the any-layout variant is kept as the fallback for strided views.
+#
+# Every variant is compiled with Numba, checked against the plain loop and
+# benchmarked on the sample arguments.  The fastest one becomes the active
+# implementation of the returned `SpecializedKernel`; strided inputs are
+# routed to the fastest any-layout variant.
+#
+# (Cython would need a C compiler at run time; Numba is already the compiler
+# used in this topic, so the generator targets it.)
+#
+def _unrolled_loop_source(n_inputs, factor):
+    """Returns the Python source of an elementwise loop unrolled by `factor`."""
+    names = [f"a{k}" for k in range(n_inputs)]
+
+    def call(offset):
+        index = "i" if offset == 0 else f"i + {offset}"
+        args = ", ".join(f"{name}[{index}]" for name in names)
+        return f"out[{index}] = scalar({args})"
+
+    lines = [f"def kernel(out, {', '.join(names)}):",
+             "    n = out.shape[0]",
+             f"    stop = n - n % {factor}",
+             f"    for i in range(0, stop, {factor}):"]
+    lines += [f"        {call(offset)}" for offset in range(factor)]
+    lines += ["    for i in range(stop, n):",
+              f"        {call(0)}"]
+    return "\n".join(lines) + "\n"
+
+
+class SpecializedKernel:
+    """
+    An elementwise kernel with generated, benchmarked variants.
+
+    Call it like a ufunc: `kernel(x, y)` or `kernel(x, y, out=buffer)`.
+    All inputs and `out` must have the same length: the variants are
+    compiled without bounds checks.
+    """
+    def __init__(self, scalar, out_dtype):
+        self.scalar = scalar
+        self.out_dtype = out_dtype
+        self.variants = {}   # name -> compiled loop
+        self.sources = {}    # name -> generated source
+        self.timings = {}    # name -> best time in seconds
+        self.active = None
+        self.active_strided = None
+
+    def add_variant(self, name, source, compiled):
+        self.variants[name] = compiled
+        self.sources[name] = source
+
+    def install_fastest(self):
+        """Makes the fastest measured variant (and strided fallback) active."""
+        self.active = min(self.timings, key=self.timings.get)
+        strided = {n: t for n, t in self.timings.items() if n.endswith("_any")}
+        self.active_strided = min(strided, key=strided.get)
+
+    def __call__(self, *arrays, out=None):
+        lengths = [a.shape[0] for a in arrays + (() if out is None else (out,))]
+        if len(set(lengths)) > 1:
+            raise ValueError(f"Inputs and out must have the same length, got {lengths}")
+        if out is None:
+            out = np.empty(arrays[0].shape[0], dtype=self.out_dtype)
+        contiguous = all(a.flags.c_contiguous for a in arrays + (out,))
+        name = self.active if contiguous else self.active_strided
+        self.variants[name](out, *arrays)
+        return out
+
+
+def specialize_kernel(scalar, *sample_args, factors=(1, 2, 4, 8), repeats=5):
+    """
+    Generates unrolled, type-specialized variants of a scalar kernel and
+    installs the fastest one.
+
+    Args:
+        scalar: A plain Python function of scalars, e.g. `lambda x, y: x + y`.
+        *sample_args: 1-D NumPy arrays representative of the real inputs
+            (their dtypes fix the compiled signatures).
+        factors: Unroll factors to generate.
+        repeats: Timed runs per variant; the best time is kept.
+
+    Returns:
+        A `SpecializedKernel` with `active` set to the fastest variant.
+    """
+    scalar_jit = njit(inline="always")(scalar)
+    # Let Numba infer the scalar result type for the output signature.
+    probe = scalar_jit(*(a[0] for a in sample_args))
+    out_dtype = np.asarray(probe).dtype
+    kernel = SpecializedKernel(scalar, out_dtype)
+
+    item_types = [numba.from_dtype(a.dtype) for a in sample_args]
+    out_type = numba.from_dtype(out_dtype)
+    reference = np.empty(len(sample_args[0]), dtype=out_dtype)
+    for k in range(len(reference)):
+        reference[k] = scalar(*(a[k] for a in sample_args))
+
+    for factor in factors:
+        source = _unrolled_loop_source(len(sample_args), factor)
+        for layout, array_layout in (("contig", "C"), ("any", "A")):
+            namespace = {"scalar": scalar_jit}
+            exec(source, namespace)
+            signature = numba.void(out_type[::1] if layout == "contig" else out_type[:],
+                                   *(t[::1] if layout == "contig" else t[:] for t in item_types))
+            compiled = njit(signature)(namespace["kernel"])
+            name = f"unroll{factor}_{layout}"
+            kernel.add_variant(name, source, compiled)
+
+            out = np.empty_like(reference)
+            compiled(out, *sample_args)
+            np.testing.assert_allclose(out, reference, rtol=1e-12)
+            best = float("inf")
+            for _ in range(repeats):
+                start_time = time.perf_counter()
+                compiled(out, *sample_args)
+                best = min(best, time.perf_counter() - start_time)
+            kernel.timings[name] = best
+
+    kernel.install_fastest()
+    return kernel
+
+
+# Example: specializing the loop from demonstrate_loop_unrolling
+def demonstrate_kernel_specialization(a, b):
+    def add(x, y):
+        return x + y
+
+    def challenge(x, y):
+        return math.exp(-(x - y)**2) / (1 + (x + y)**2)
+
+    for scalar, expected in ((add, a + b), (challenge, optimized_computation_numexpr(a, b))):
+        kernel = specialize_kernel(scalar, a, b)
+        print(f"{scalar.__name__}: active variant = {kernel.active} "
+              f"(strided fallback = {kernel.active_strided})")
+        for name, seconds in sorted(kernel.timings.items(), key=lambda item: item[1]):
+            print(f"    {name:<16} {seconds * 1e3:8.3f} ms")
+        np.testing.assert_allclose(kernel(a, b), expected, rtol=1e-12)
+        np.testing.assert_allclose(kernel(a[::2], b[::2]), expected[::2], rtol=1e-12)
+    # No bounds checks in the loops: mismatched lengths are refused up front.
+    for args, out in (((a, b[:10]), None), ((a, b), np.empty(10))):
+        try:
+            kernel(*args, out=out)
+        except ValueError as e:
+            print(f"Rejected: {e}")
+        else:
+            raise AssertionError("mismatched lengths were accepted")
+    return kernel
+
+
+
 
 
 if __name__ == "__main__":
     print("Exploring Loop Unrolling:")
     a,b = demonstrate_loop_unrolling()
+    print("\nGenerating specialized loop variants:")
+    demonstrate_kernel_specialization(a, b)
     print("\nExploring Numba:")
     python_time, numba_nopython_time, numba_object_time = demonstrate_numba(a, b)
     numba_parallel_time = demonstrate_numba_parallel(a,b)
@@ -446,4 +1113,7 @@ if __name__ == "__main__":
     print(f"Numexpr vs Numba Speedup: {numba_time_challenge/numexpr_time_challenge:.2f}x")
 
     # Verify the results are the same (within a tolerance)
-    np.testing.assert_allclose(result_numexpr_challenge, result_numba_challenge, rtol=1e-5)
\ No newline at end of file
+    np.testing.assert_allclose(result_numexpr_challenge, result_numba_challenge, rtol=1e-5)
+
+    print("\nRunning the expression engine on the challenge:")
+    demonstrate_expression_engine(x_challenge, y_challenge)
\ No newline at end of file
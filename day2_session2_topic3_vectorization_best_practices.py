@@ -331,6 +331,294 @@ def example_non_vectorizable(data):
                 cumulative_sum += data[i, j]
             result[i, j] = cumulative_sum
     return result
+
+# -----------------------------------------------------------------------------
+# Stateful Loops Are Often Prefix Scans
+# -----------------------------------------------------------------------------
+#
+# `example_non_vectorizable` looks hard to vectorize because every output
+# depends on all previous inputs.  But the state it carries is combined with
+# an *associative* operation (addition), and the condition only decides
+# whether an element contributes.  That is a masked prefix scan:
+#
+#   result = cumsum(where(data > 0, data, 0))      (in C order)
+#
+# The same idea covers a family of loops that show up in ETL code:
+#
+# -   conditional cumsum:   skip elements that fail a predicate
+# -   running max / min:    np.maximum.accumulate / np.minimum.accumulate
+# -   reset-on-flag sums:   the running total restarts where a flag is set
+# -   segment scans:        the running total restarts where a key changes
+#
+# `scan()` implements all of them with two backends:
+#
+# -   "numpy": ufunc `accumulate` plus a little index arithmetic for resets.
+#     Summing with resets subtracts the running total at each reset, so for
+#     floats the result can differ from a sequential loop by rounding error.
+# -   "numba": a compiled, block-parallel two-pass scan.  Pass 1 scans every
+#     block independently (in parallel) and records each block's total.
+#     A short sequential pass turns the block totals into per-block carries.
+#     Pass 2 folds each carry into its block (in parallel) up to the block's
+#     first reset.  The additions happen in the same order as the sequential
+#     loop, except that sums are grouped per block.
+#
+# Both backends work chunk by chunk (`chunk_size`) and carry the running
+# value from one chunk into the next, so `values` and `out` can be
+# `np.memmap` arrays far larger than RAM.
+#
+# Numba is optional here: without it only the NumPy backend is available.
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+SCAN_OPS = {
+    "sum": np.add,
+    "prod": np.multiply,
+    "max": np.maximum,
+    "min": np.minimum,
+}
+_SCAN_OP_CODES = {"sum": 0, "prod": 1, "max": 2, "min": 3}
+
+
+def _scan_identity(op, dtype):
+    """The identity element of `op` for `dtype` (0 for sum, -inf for max, ...)."""
+    if op == "sum":
+        return dtype.type(0)
+    if op == "prod":
+        return dtype.type(1)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return dtype.type(info.min if op == "max" else info.max)
+    return dtype.type(-np.inf if op == "max" else np.inf)
+
+
+def _scan_block_numpy(values, op, mask, reset):
+    """Scans one 1-D block from the identity, honouring mask and reset flags."""
+    ufunc = SCAN_OPS[op]
+    if mask is not None:
+        values = np.where(mask, values, _scan_identity(op, values.dtype))
+    if reset is None or not reset.any():
+        return ufunc.accumulate(values, dtype=values.dtype)
+    if op == "sum":
+        totals = np.cumsum(values, dtype=values.dtype)
+        # Position of the most recent reset at or before each element (-1: none).
+        last_reset = np.maximum.accumulate(np.where(reset, np.arange(len(values)), -1))
+        before = totals - values  # running total just before each element
+        offset = np.where(last_reset >= 0, before[np.maximum(last_reset, 0)], 0)
+        return totals - offset
+    # Other operations have no inverse; accumulate each run between resets.
+    out = np.empty_like(values)
+    bounds = np.unique(np.concatenate(([0], np.flatnonzero(reset), [len(values)])))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        ufunc.accumulate(values[start:stop], out=out[start:stop])
+    return out
+
+
+def _apply_carry(out, carry, reset, op):
+    """Folds the running value of previous blocks into `out` up to the first reset."""
+    first_reset = len(out)
+    if reset is not None:
+        hits = np.flatnonzero(reset)
+        if len(hits):
+            first_reset = hits[0]
+    SCAN_OPS[op](carry, out[:first_reset], out=out[:first_reset])
+
+
+if njit is not None:
+    @njit(inline="always")
+    def _scan_combine(code, a, b):
+        if code == 0:
+            return a + b
+        elif code == 1:
+            return a * b
+        elif code == 2:
+            return a if a >= b else b
+        return a if a <= b else b
+
+    @njit(parallel=True)
+    def _scan_two_pass(values, mask, use_mask, reset, use_reset, out,
+                       code, identity, carry_in, block_size):
+        n = values.shape[0]
+        n_blocks = (n + block_size - 1) // block_size
+        block_total = np.empty(n_blocks, dtype=out.dtype)
+        block_has_reset = np.zeros(n_blocks, dtype=np.bool_)
+
+        # Pass 1: independent scan of every block.
+        for b in prange(n_blocks):
+            start = b * block_size
+            stop = min(start + block_size, n)
+            acc = identity
+            for i in range(start, stop):
+                if use_reset and reset[i]:
+                    acc = identity
+                    block_has_reset[b] = True
+                if not use_mask or mask[i]:
+                    acc = _scan_combine(code, acc, values[i])
+                out[i] = acc
+            block_total[b] = acc
+
+        # Sequential carry propagation over the (few) block totals.
+        carries = np.empty(n_blocks, dtype=out.dtype)
+        carry = carry_in
+        for b in range(n_blocks):
+            carries[b] = carry
+            if block_has_reset[b]:
+                carry = block_total[b]
+            else:
+                carry = _scan_combine(code, carry, block_total[b])
+
+        # Pass 2: fold each block's carry in, up to its first reset.
+        for b in prange(n_blocks):
+            start = b * block_size
+            stop = min(start + block_size, n)
+            c = carries[b]
+            for i in range(start, stop):
+                if use_reset and reset[i]:
+                    break
+                out[i] = _scan_combine(code, c, out[i])
+
+
+def scan(values, op="sum", mask=None, reset=None, segments=None, backend="numpy",
+         out=None, chunk_size=None, block_size=1 << 16):
+    """
+    Inclusive prefix scan over `values` in C order.
+
+    Args:
+        values: Array to scan (any shape; may be a C-contiguous `np.memmap`).
+        op: "sum", "prod", "max" or "min".
+        mask: Boolean array, or a callable `mask(chunk) -> bool array`.  Elements
+            where it is False do not contribute but still receive the running value.
+        reset: Boolean array; the scan restarts (from the identity) at True.
+        segments: Array of segment keys; the scan restarts where the key changes.
+        backend: "numpy" or "numba" (block-parallel two-pass scan).
+        out: Optional C-contiguous output array of the same shape (may be an
+            `np.memmap`).
+        chunk_size: Number of elements processed per chunk (default: all).
+        block_size: Block size of the "numba" backend.
+
+    Returns:
+        The scanned array (`out` if given), with the dtype of `values`.
+    """
+    if op not in SCAN_OPS:
+        raise ValueError(f"Unknown scan op {op!r}; expected one of {sorted(SCAN_OPS)}")
+    if backend == "numba" and njit is None:
+        raise ImportError("The 'numba' scan backend requires Numba to be installed")
+    if backend not in ("numpy", "numba"):
+        raise ValueError(f"Unknown backend {backend!r}; expected 'numpy' or 'numba'")
+    # reshape(-1) copies a non-contiguous array: for `out` the results would
+    # land in the copy, and a memmap would be read into memory in one go.
+    if out is not None and not out.flags.c_contiguous:
+        raise ValueError("out must be C-contiguous; scan into a contiguous array "
+                         "and copy it into out afterwards")
+    for name, array in (("values", values), ("segments", segments)):
+        if isinstance(array, np.memmap) and not array.flags.c_contiguous:
+            raise ValueError(f"{name} is a non-C-contiguous np.memmap, which would be "
+                             f"loaded into memory whole; pass it in C order")
+
+    flat = values.reshape(-1)
+    if out is None:
+        out = np.empty(values.shape, dtype=values.dtype)
+    flat_out = out.reshape(-1)
+    flat_mask = None if mask is None or callable(mask) else np.asarray(mask).reshape(-1)
+    flat_reset = None if reset is None else np.asarray(reset).reshape(-1)
+    flat_segments = None if segments is None else segments.reshape(-1)
+
+    n = flat.shape[0]
+    chunk_size = chunk_size or max(n, 1)
+    identity = _scan_identity(op, values.dtype)
+    carry = identity
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        chunk = np.asarray(flat[start:stop])  # reads this chunk from a memmap
+        chunk_mask = mask(chunk) if callable(mask) else (
+            None if flat_mask is None else flat_mask[start:stop])
+        chunk_reset = None if flat_reset is None else flat_reset[start:stop]
+        if flat_segments is not None:
+            keys = np.asarray(flat_segments[max(start - 1, 0):stop])
+            changed = keys[1:] != keys[:-1]
+            # The first element of the array starts a segment; later chunks
+            # compare their first key with the last key of the previous chunk.
+            changed = np.concatenate(([True], changed)) if start == 0 else changed
+            chunk_reset = changed if chunk_reset is None else (chunk_reset | changed)
+
+        if backend == "numpy":
+            local = _scan_block_numpy(chunk, op, chunk_mask, chunk_reset)
+            _apply_carry(local, carry, chunk_reset, op)
+            flat_out[start:stop] = local
+        else:
+            empty = np.empty(0, dtype=np.bool_)
+            _scan_two_pass(chunk,
+                           empty if chunk_mask is None else np.ascontiguousarray(chunk_mask),
+                           chunk_mask is not None,
+                           empty if chunk_reset is None else np.ascontiguousarray(chunk_reset),
+                           chunk_reset is not None,
+                           np.asarray(flat_out[start:stop]),
+                           _SCAN_OP_CODES[op], identity, carry, block_size)
+        carry = flat_out[stop - 1]
+    return out
+
+
+def conditional_cumsum(data, backend="numpy", **kwargs):
+    """Vectorized `example_non_vectorizable`: cumsum of the positive elements."""
+    return scan(data, "sum", mask=lambda chunk: chunk > 0, backend=backend, **kwargs)
+
+
+def running_max(data, backend="numpy", **kwargs):
+    """Running maximum in C order."""
+    return scan(data, "max", backend=backend, **kwargs)
+
+
+def reset_sum(data, flags, backend="numpy", **kwargs):
+    """Running sum that restarts at every element where `flags` is True."""
+    return scan(data, "sum", reset=flags, backend=backend, **kwargs)
+
+
+def segment_scan(data, segment_ids, op="sum", backend="numpy", **kwargs):
+    """Running `op` that restarts wherever `segment_ids` changes value."""
+    return scan(data, op, segments=segment_ids, backend=backend, **kwargs)
+
+
+# Example: the stateful loop versus the scan engine
+def demonstrate_prefix_scan(shape=(1000, 1000)):
+    data = np.random.randn(*shape)
+
+    start_time = time.time()
+    result_loop = example_non_vectorizable(data)
+    loop_time = time.time() - start_time
+    print(f"Python double loop time: {loop_time:.4f} seconds")
+
+    backends = ("numpy", "numba") if njit is not None else ("numpy",)
+    for backend in backends:
+        conditional_cumsum(data[:2], backend=backend)  # compile outside the timed region
+        start_time = time.time()
+        result_scan = conditional_cumsum(data, backend=backend)
+        scan_time = time.time() - start_time
+        print(f"Scan ({backend}) time: {scan_time:.4f} seconds "
+              f"(speedup {loop_time / scan_time:.1f}x)")
+        np.testing.assert_allclose(result_loop, result_scan, rtol=1e-9, atol=1e-9)
+
+    # The same scan over a memory-mapped file, one chunk at a time.
+    import os
+    import tempfile
+    with tempfile.TemporaryDirectory() as temp_dir:
+        src = np.memmap(os.path.join(temp_dir, "values.dat"), dtype=np.float64,
+                        mode="w+", shape=shape)
+        src[:] = data
+        dst = np.memmap(os.path.join(temp_dir, "scan.dat"), dtype=np.float64,
+                        mode="w+", shape=shape)
+        conditional_cumsum(src, out=dst, chunk_size=100_000)
+        np.testing.assert_allclose(result_loop, dst, rtol=1e-9, atol=1e-9)
+        print("Chunked scan over np.memmap matches the loop.")
+        # Transposed views are not C-contiguous: flattening them would copy.
+        for kwargs in ({"data": src.T}, {"data": data.T, "out": dst.T}):
+            try:
+                conditional_cumsum(chunk_size=100_000, **kwargs)
+            except ValueError as e:
+                print(f"Rejected: {e}")
+            else:
+                raise AssertionError("non-contiguous memmap was accepted")
+        del src, dst
 # -----------------------------------------------------------------------------
 # Code Examples
 # -----------------------------------------------------------------------------
@@ -404,6 +692,8 @@ if __name__ == "__main__":
     data = demonstrate_advanced_vectorization(a,b)
     print("\nExample of non vectorizable:")
     print(example_non_vectorizable(data))
+    print("\nThe same loop as a prefix scan:")
+    demonstrate_prefix_scan()
 
     print("\nRunning Challenge:")
     test_image = create_test_image()
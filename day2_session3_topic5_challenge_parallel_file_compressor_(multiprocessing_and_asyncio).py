@@ -17,11 +17,21 @@ both libraries for optimal performance.
 """
 
 import asyncio
+import bz2
 import concurrent.futures
+import gzip
+import hashlib
+import json
+import lzma
+import math
+import multiprocessing
 import os
-import subprocess  # For calling gzip
+import struct
 import tempfile
-from typing import List, Tuple
+import time
+import zlib
+from multiprocessing import shared_memory
+from typing import BinaryIO, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 # -----------------------------------------------------------------------------
 # Challenge Description
@@ -72,119 +82,1837 @@ from typing import List, Tuple
 # the challenge:
 #
 # 1.  The `compress_file` function performs the CPU-bound gzip compression
-#     using the `subprocess` module.  This function is designed to be
-#     executed in a separate process.
+#     in-process with the `gzip` module, streaming the input in fixed-size
+#     reads.  This function is designed to be executed in a separate process.
 #
-# 2.  The `async_copy_file` function handles the asynchronous creation of
-#     temporary files and writing of compressed data using asyncio's
-#     `loop.run_in_executor`.
+#     An earlier version shelled out to the `gzip` program with
+#     `subprocess.run([... ">", output_file], shell=True)`.  That is broken
+#     (with `shell=True` and a list, only "gzip" reaches the shell and the
+#     remaining items, including ">", become shell positional arguments) and
+#     it forks and execs a shell plus a gzip process for every file.  For
+#     thousands of small files that fork/exec overhead dwarfs the actual
+#     compression.  The `gzip`/`zlib` modules release the GIL while
+#     compressing and cost nothing to start.
+#
+# 2.  Compressed output is streamed straight into the destination directory
+#     chosen by the caller.  Each worker writes to a temporary name next to
+#     the final file ("name.gz.<pid>.tmp") and renames it into place with
+#     `os.replace` once the file is complete.  The rename is atomic on the
+#     same file system, so a reader (or a crashed run) never sees a
+#     half-written "name.gz".
+#
+#     An earlier version compressed into a `TemporaryDirectory`, then
+#     "copied" every result onto itself inside that same directory (an
+#     `async_copy_file` helper), and finally returned paths inside the
+#     directory that had just been deleted.  Writing once to the real
+#     destination removes the copy, halves the disk I/O, and the returned
+#     paths stay valid.
 #
 # 3.  The `parallel_compress_files` coroutine orchestrates the parallel
 #     compression process using `multiprocessing` and `asyncio`.  It:
-#     - Creates a temporary directory for the compressed files.
+#     - Stats all inputs and plans tasks largest-first, batching small files
+#       (see "Size-Aware Scheduling" below).
 #     - Creates a process pool using `concurrent.futures.ProcessPoolExecutor`.
-#     - Submits the `compress_file` tasks to the process pool.
-#     - Uses `asyncio.gather` to wait for the compression tasks to complete.
-#     - Uses `asyncio.to_thread` to run the file copying in a separate thread.
-#     - Returns the paths to the compressed files.
+#     - Submits the tasks to the process pool, keeping only a bounded number
+#       in flight, and waits for them with `asyncio.wait`.
+#     - Returns the paths to the compressed files in the output directory.
+#
+# 4.  Files larger than `split_threshold` are handed to
+#     `parallel_compress_large_file`, which splits them into blocks that are
+#     compressed by several processes and reassembled as a multi-member gzip
+#     stream (see the section below).
+#
+# 5.  `pipelined_compress_files` handles streams of files too large to plan
+#     up front, with bounded read/compress/write stages (see below).
+#
+# 6.  `parallel_decompress_files` is the inverse: it restores or verifies
+#     archives in parallel (see "Restoring and Verifying Archives").
 #
-# 4.  The main part of the script calls `asyncio.run` to execute the
+# 7.  The main part of the script calls `asyncio.run` to execute the
 #     `parallel_compress_files` coroutine.
 #
-def compress_file(input_file: str, temp_dir: str) -> str:
+DEFAULT_BUFFER_SIZE = 1024 * 1024  # Bytes read from the input per iteration
+DEFAULT_CODEC = "gzip"             # See "Pluggable Codecs" below
+
+
+def output_path(input_file: str, output_dir: str, codec: str = DEFAULT_CODEC,
+                root: Optional[str] = None) -> str:
+    """
+    Returns where the compressed copy of `input_file` goes.
+
+    With `root`, the directory layout below `root` is mirrored inside
+    `output_dir`; otherwise the file lands directly in `output_dir`.
+    """
+    name = os.path.relpath(input_file, root) if root else os.path.basename(input_file)
+    return os.path.join(output_dir, name + get_codec(codec).extension)
+
+
+def _temporary_path(output_file: str) -> str:
+    """A per-process scratch name in the same directory (so rename is atomic)."""
+    return f"{output_file}.{os.getpid()}.tmp"
+
+
+class CompressionResult(NamedTuple):
+    """Outcome of compressing one file."""
+    input_file: str
+    output_file: str
+    input_bytes: int
+    output_bytes: int
+    seconds: float
+    # Worker time of each block, for files compressed in parallel blocks
+    block_seconds: Tuple[float, ...] = ()
+    # Content hash of the input (incremental runs with hash_content=True)
+    content_hash: Optional[str] = None
+    # True when an unchanged file's existing output was reused
+    skipped: bool = False
+
+    @property
+    def ratio(self) -> float:
+        """Compressed size as a fraction of the original size."""
+        return self.output_bytes / self.input_bytes if self.input_bytes else 1.0
+
+
+def compress_file(input_file: str, output_dir: str,
+                  level: Optional[int] = None,
+                  buffer_size: int = DEFAULT_BUFFER_SIZE,
+                  codec: str = DEFAULT_CODEC,
+                  root: Optional[str] = None,
+                  hash_content: bool = False) -> Optional[CompressionResult]:
     """
-    Compresses a file using gzip and saves it to a temporary directory.
+    Compresses a file (gzip by default) directly into `output_dir`.
     This function is intended to be run in a separate process.
 
+    The input is streamed through the codec's writer in `buffer_size` reads,
+    so memory use is bounded regardless of the file size.  The output is
+    written under a temporary name and atomically renamed when complete.
+
     Args:
         input_file: Path to the file to compress.
-        temp_dir: Path to the temporary directory.
+        output_dir: Destination directory.
+        level: Compression level (default: the codec's default level).
+        buffer_size: Number of bytes read from the input per iteration.
+        codec: Name of a codec in `CODECS`.
+        root: If given, the layout below `root` is mirrored in `output_dir`.
+        hash_content: Also hash the input while streaming it (see
+            "Incremental Runs" below).
 
     Returns:
-        Path to the compressed file, or None on error.
+        A CompressionResult with the real sizes and timing, or None on error.
     """
+    tmp_file = None
+    hasher = _new_hasher() if hash_content else None
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
     try:
-        # Generate a unique filename for the compressed file in the temp dir
-        output_file = os.path.join(temp_dir, os.path.basename(input_file) + ".gz")
-        # Use subprocess.run to execute the gzip command.
-        result = subprocess.run(
-            ["gzip", "-c", input_file, ">", output_file],  # Use shell redirection
-            shell=True,  # Enable shell redirection
-            check=True,  # Raise an exception on non-zero exit code
-            capture_output=True,  # Capture standard output and error
-            # text=True,  # Remove text mode, handle binary data
-        )
-        print(f"Process {os.getpid()}: Compressed {input_file} to {output_file}")
-        return output_file
-    except subprocess.CalledProcessError as e:
+        codec_info = get_codec(codec)
+        level = codec_info.default_level if level is None else level
+        output_file = output_path(input_file, output_dir, codec, root)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        tmp_file = _temporary_path(output_file)
+        input_bytes = 0
+        with open(input_file, "rb") as src, open(tmp_file, "wb") as raw:
+            with codec_info.open_writer(raw, level) as writer:
+                while True:
+                    chunk = src.read(buffer_size)
+                    if not chunk:
+                        break
+                    writer.write(chunk)
+                    input_bytes += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+            output_bytes = raw.tell()
+        os.replace(tmp_file, output_file)
+        tmp_file = None
+        content_hash = f"{HASH_ALGORITHM}:{hasher.hexdigest()}" if hasher is not None else None
+        result = CompressionResult(input_file, output_file, input_bytes, output_bytes,
+                                   time.perf_counter() - start_time, content_hash=content_hash)
+        # Per-file outcomes go to the shared counters, not to stdout
+        # (see "Metrics Shared Across Processes").
+        record_work(input_bytes, output_bytes, result.seconds, time.process_time() - start_cpu)
+        return result
+    except OSError as e:
         print(f"Process {os.getpid()}: Error compressing {input_file}: {e}")
-        print(f"Process {os.getpid()} Stderr: {e.stderr.decode()}")  # Decode binary stderr
-        return None
     except Exception as e:
         print(f"Process {os.getpid()}: Unexpected error compressing {input_file}: {e}")
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)  # Never leave a partial file behind
+    record_work(0, 0, time.perf_counter() - start_time, time.process_time() - start_cpu,
+                error=True)
+    return None
+
+
+
+# -----------------------------------------------------------------------------
+# Pluggable Codecs
+# -----------------------------------------------------------------------------
+#
+# gzip is a reasonable default, but not the best trade-off for every kind of
+# data.  Text logs compress very well with slow codecs, while already
+# compressed binaries (images, archives) gain almost nothing from any codec
+# and should use the fastest level available.
+#
+#   codec   stdlib?  speed        ratio        concatenable streams
+#   ------  -------  -----------  -----------  --------------------
+#   zlib    yes      fast         good         no (single stream)
+#   gzip    yes      fast         good         yes (multi-member)
+#   bz2     yes      slow         better       yes (multi-stream)
+#   lzma    yes      very slow    best         yes (multi-stream)
+#   zstd    no       very fast    good-best    yes (multi-frame)
+#   lz4     no       fastest      modest       yes (multi-frame)
+#
+# Each codec is described by a `Codec` entry in the `CODECS` registry.  zstd
+# (`zstandard` package) and lz4 (`lz4` package) are registered only when they
+# are installed.  Worker processes receive the codec *name* and look it up in
+# the registry, so nothing unpicklable crosses the process boundary.
+#
+# Which codec and level to use is a measurement, not a guess:
+# `benchmark_codecs` compresses a sample of a few MB taken from spread-out
+# offsets of the inputs at several levels of every codec, and
+# `recommend_codec` picks the best ratio that meets a throughput target (or
+# the fastest setting that meets a ratio target).  `recommend_codecs_by_type`
+# does this per file extension, since logs and binaries want different
+# trade-offs.
+#
+class Codec(NamedTuple):
+    """How to compress with one algorithm."""
+    name: str
+    extension: str
+    default_level: int
+    levels: Tuple[int, ...]                      # Levels worth benchmarking
+    open_writer: Callable[[BinaryIO, int], BinaryIO]
+    compress: Callable[[bytes, int], bytes]      # One-shot compression
+    concatenable: bool                           # Independent blocks can be joined
+    open_reader: Callable[[BinaryIO], BinaryIO]  # Streaming decompression
+
+
+class _ZlibWriter:
+    """File-like writer producing a raw zlib stream (the stdlib has none)."""
+    def __init__(self, raw: BinaryIO, level: int):
+        self._raw = raw
+        self._compressor = zlib.compressobj(level)
+
+    def write(self, data) -> int:
+        self._raw.write(self._compressor.compress(data))
+        return len(data)
+
+    def close(self) -> None:
+        self._raw.write(self._compressor.flush())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _ZlibReader:
+    """File-like reader decompressing a raw zlib stream."""
+    def __init__(self, raw: BinaryIO):
+        self._raw = raw
+        self._decompressor = zlib.decompressobj()
+
+    def read(self, size: int = DEFAULT_BUFFER_SIZE) -> bytes:
+        while not self._decompressor.eof:
+            data = self._decompressor.unconsumed_tail or self._raw.read(size)
+            if not data:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            out = self._decompressor.decompress(data, size)
+            if out:
+                return out
+        return b""
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+CODECS: Dict[str, Codec] = {
+    "gzip": Codec("gzip", ".gz", 6, (1, 6, 9),
+                  # filename="" keeps the temporary output name out of the header
+                  lambda raw, level: gzip.GzipFile(filename="", mode="wb", compresslevel=level,
+                                                   fileobj=raw),
+                  lambda data, level: gzip.compress(data, compresslevel=level, mtime=0),
+                  True,
+                  lambda raw: gzip.GzipFile(fileobj=raw, mode="rb")),
+    "zlib": Codec("zlib", ".zz", 6, (1, 6, 9),
+                  _ZlibWriter,
+                  lambda data, level: zlib.compress(data, level),
+                  False,
+                  _ZlibReader),
+    "bz2": Codec("bz2", ".bz2", 9, (1, 9),
+                 lambda raw, level: bz2.BZ2File(raw, "wb", compresslevel=level),
+                 lambda data, level: bz2.compress(data, level),
+                 True,
+                 lambda raw: bz2.BZ2File(raw, "rb")),
+    "lzma": Codec("lzma", ".xz", 6, (0, 3, 6),
+                  lambda raw, level: lzma.LZMAFile(raw, "wb", preset=level),
+                  lambda data, level: lzma.compress(data, preset=level),
+                  True,
+                  lambda raw: lzma.LZMAFile(raw, "rb")),
+}
+
+try:
+    import zstandard
+    CODECS["zstd"] = Codec(
+        "zstd", ".zst", 3, (1, 3, 9, 19),
+        lambda raw, level: zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False),
+        lambda data, level: zstandard.ZstdCompressor(level=level).compress(data),
+        True,
+        lambda raw: zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                                closefd=False))
+except ImportError:
+    pass
+
+try:
+    import lz4.frame
+    CODECS["lz4"] = Codec(
+        "lz4", ".lz4", 0, (0, 9),
+        lambda raw, level: lz4.frame.LZ4FrameFile(raw, mode="wb", compression_level=level),
+        lambda data, level: lz4.frame.compress(data, compression_level=level),
+        True,
+        lambda raw: lz4.frame.LZ4FrameFile(raw, mode="rb"))
+except ImportError:
+    pass
+
+
+def get_codec(name: str) -> Codec:
+    """Looks up a codec by name, with a helpful error for unknown/missing ones."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown or unavailable codec {name!r}; "
+                         f"available: {sorted(CODECS)}") from None
+
+
+class CodecBenchmark(NamedTuple):
+    """Result of compressing the benchmark sample with one codec/level."""
+    codec: str
+    level: int
+    input_bytes: int
+    output_bytes: int
+    seconds: float
+
+    @property
+    def ratio(self) -> float:
+        return self.output_bytes / self.input_bytes if self.input_bytes else 1.0
+
+    @property
+    def throughput(self) -> float:
+        """Uncompressed MB per second."""
+        return self.input_bytes / 1e6 / self.seconds if self.seconds else float("inf")
+
+
+def read_sample(input_files: List[str], sample_bytes: int = 4 * 1024 * 1024,
+                piece_bytes: int = 256 * 1024) -> bytes:
+    """
+    Reads about `sample_bytes` from the inputs, in pieces taken at evenly
+    spaced offsets so that headers, bodies and tails are all represented.
+    """
+    per_file = max(piece_bytes, sample_bytes // max(len(input_files), 1))
+    pieces = []
+    for input_file in input_files:
+        try:
+            size = os.path.getsize(input_file)
+            with open(input_file, "rb") as f:
+                count = max(1, min(per_file, size) // piece_bytes)
+                step = max(size - piece_bytes, 0) // max(count - 1, 1)
+                for k in range(count):
+                    f.seek(k * step)
+                    pieces.append(f.read(piece_bytes))
+        except OSError as e:
+            print(f"Skipping {input_file} in sample: {e}")
+        if sum(len(p) for p in pieces) >= sample_bytes:
+            break
+    return b"".join(pieces)[:sample_bytes]
+
+
+def benchmark_codecs(input_files: List[str], codecs: Optional[List[str]] = None,
+                     sample_bytes: int = 4 * 1024 * 1024) -> List[CodecBenchmark]:
+    """
+    Compresses a sample of the inputs with every codec at its benchmark levels.
+
+    Args:
+        input_files: Files the sample is drawn from.
+        codecs: Codec names to try (default: all available).
+        sample_bytes: Approximate size of the sample.
+
+    Returns:
+        One CodecBenchmark per codec/level.
+    """
+    sample = read_sample(input_files, sample_bytes)
+    results = []
+    for name in codecs or sorted(CODECS):
+        codec = get_codec(name)
+        for level in codec.levels:
+            start_time = time.perf_counter()
+            compressed = codec.compress(sample, level)
+            seconds = time.perf_counter() - start_time
+            results.append(CodecBenchmark(name, level, len(sample), len(compressed), seconds))
+    return results
+
+
+def recommend_codec(results: List[CodecBenchmark], min_throughput: Optional[float] = None,
+                    max_ratio: Optional[float] = None) -> Optional[CodecBenchmark]:
+    """
+    Picks a codec/level from benchmark results.
+
+    Args:
+        results: Output of `benchmark_codecs`.
+        min_throughput: Required speed in MB/s; the smallest output among the
+            settings that are fast enough wins.
+        max_ratio: Required compressed/original ratio; the fastest setting
+            among those that compress well enough wins.
+
+    Returns:
+        The recommended setting, or None if no setting meets the targets.
+    """
+    candidates = [r for r in results
+                  if (min_throughput is None or r.throughput >= min_throughput)
+                  and (max_ratio is None or r.ratio <= max_ratio)]
+    if not candidates:
         return None
+    if max_ratio is not None and min_throughput is None:
+        return max(candidates, key=lambda r: r.throughput)
+    return min(candidates, key=lambda r: (r.ratio, -r.throughput))
+
+
+def recommend_codecs_by_type(input_files: List[str], min_throughput: Optional[float] = None,
+                             max_ratio: Optional[float] = None,
+                             sample_bytes: int = 4 * 1024 * 1024) -> Dict[str, Optional[CodecBenchmark]]:
+    """Runs `benchmark_codecs`/`recommend_codec` separately per file extension."""
+    by_type: Dict[str, List[str]] = {}
+    for input_file in input_files:
+        by_type.setdefault(os.path.splitext(input_file)[1].lower(), []).append(input_file)
+    return {extension: recommend_codec(benchmark_codecs(files, sample_bytes=sample_bytes),
+                                       min_throughput, max_ratio)
+            for extension, files in by_type.items()}
+
+
+
+# -----------------------------------------------------------------------------
+# Block-Parallel Compression of a Single Large File (pigz-style)
+# -----------------------------------------------------------------------------
+#
+# Parallelizing across files leaves one core doing all the work when a single
+# file dominates the batch (one 50 GB log next to a few small configs).
+#
+# The gzip format allows a file to consist of several independent "members"
+# concatenated back to back; `gzip -d`, `zcat` and Python's `gzip` module
+# decompress such a file as one continuous stream.  So a large file can be
+# cut into fixed-size blocks, each block compressed into its own member by a
+# different process, and the members written out in their original order:
+#
+#   input:   [ block 0 ][ block 1 ][ block 2 ][ block 3 ] ...
+#                |          |          |          |
+#             worker A   worker B   worker C   worker A       (in parallel)
+#                |          |          |          |
+#   output:  [member 0 ][member 1 ][member 2 ][member 3 ] ... (in order)
+#
+# Each worker reads its own block from disk (only the offset and length are
+# sent to it), and at most `max_in_flight` blocks are pending at any time, so
+# memory use stays at roughly `max_in_flight * block_size` however large the
+# file is.  The cost is a slightly worse ratio than one single stream, because
+# each member starts with an empty history window; with blocks of a few MB
+# that loss is well under 1%.
+#
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def compress_block(input_file: str, offset: int, length: int,
+                   level: Optional[int] = None, codec: str = DEFAULT_CODEC) -> Tuple[bytes, float]:
+    """
+    Reads `length` bytes at `offset` and compresses them into one gzip member
+    (or one stream/frame of another concatenable codec).
+    This function is intended to be run in a separate process.
+
+    Args:
+        input_file: Path to the file the block belongs to.
+        offset: Byte offset of the block.
+        length: Number of bytes in the block.
+        level: Compression level (default: the codec's default level).
+        codec: Name of a concatenable codec in `CODECS`.
+
+    Returns:
+        The complete member (for gzip: header, deflate data and CRC trailer)
+        and the seconds this worker spent reading and compressing the block.
+    """
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    codec_info = get_codec(codec)
+    with open(input_file, "rb") as src:
+        src.seek(offset)
+        data = src.read(length)
+    # gzip's one-shot compress uses mtime=0, so identical input gives identical output.
+    member = codec_info.compress(data, codec_info.default_level if level is None else level)
+    seconds = time.perf_counter() - start_time
+    record_work(len(data), len(member), seconds, time.process_time() - start_cpu)
+    return member, seconds
+
+
+async def parallel_compress_large_file(input_file: str, output_file: str,
+                                       level: Optional[int] = None,
+                                       block_size: int = DEFAULT_BLOCK_SIZE,
+                                       executor: Optional[concurrent.futures.Executor] = None,
+                                       max_in_flight: Optional[int] = None,
+                                       codec: str = DEFAULT_CODEC) -> CompressionResult:
+    """
+    Compresses one file by splitting it into blocks compressed across processes.
+
+    Args:
+        input_file: Path to the file to compress.
+        output_file: Path of the multi-member .gz file to write (written under
+            a temporary name and atomically renamed when complete).
+        level: Compression level (default: the codec's default level).
+        block_size: Uncompressed bytes per block / gzip member.
+        executor: Process pool to use (a new one is created if None).
+        max_in_flight: Maximum number of blocks submitted but not yet written
+            (default: twice the CPU count).
+        codec: Name of a concatenable codec in `CODECS` (not "zlib").
+
+    Returns:
+        A CompressionResult for the whole file.
+    """
+    if not get_codec(codec).concatenable:
+        raise ValueError(f"Codec {codec!r} streams cannot be concatenated; "
+                         f"it cannot be used for block-parallel compression")
+    start_time = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    input_bytes = os.path.getsize(input_file)
+    max_in_flight = max_in_flight or 2 * (os.cpu_count() or 1)
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    output_bytes = 0
+    block_seconds = []
+    pending = []
+    tmp_file = _temporary_path(output_file)
+    try:
+        with open(tmp_file, "wb") as out:
+            for offset in range(0, max(input_bytes, 1), block_size):
+                length = min(block_size, input_bytes - offset)
+                pending.append(loop.run_in_executor(executor, compress_block,
+                                                    input_file, offset, length, level, codec))
+                if len(pending) >= max_in_flight:
+                    # Write the oldest block before submitting more (keeps order
+                    # and bounds the number of blocks held in memory).
+                    member, seconds = await pending.pop(0)
+                    await asyncio.to_thread(out.write, member)
+                    output_bytes += len(member)
+                    block_seconds.append(seconds)
+            for future in pending:
+                member, seconds = await future
+                await asyncio.to_thread(out.write, member)
+                output_bytes += len(member)
+                block_seconds.append(seconds)
+        os.replace(tmp_file, output_file)
+    finally:
+        for future in pending:
+            future.cancel()
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        if own_executor:
+            executor.shutdown()
+    return CompressionResult(input_file, output_file, input_bytes, output_bytes,
+                             time.perf_counter() - start_time, tuple(block_seconds))
+
+
+
+# -----------------------------------------------------------------------------
+# Size-Aware Scheduling (Largest Processing Time First)
+# -----------------------------------------------------------------------------
+#
+# `ProcessPoolExecutor` hands tasks to idle workers in submission order.  If
+# the biggest file happens to be submitted last, every other worker finishes
+# early and then waits while one worker compresses it alone:
+#
+#   list order:      w0 |a|b|c|d|HUGE.............|      <- makespan
+#                    w1 |e|f|g|h|  (idle)
+#
+#   largest first:   w0 |HUGE.............|
+#                    w1 |a|b|c|d|e|f|g|h|..|          <- makespan
+#
+# Sorting tasks by size, largest first, is the classic LPT heuristic; its
+# makespan is provably within 4/3 of the optimum.  The scheduler therefore
+# stats every input before submitting anything, and:
+#
+# -   orders tasks largest-first;
+# -   packs tiny files into batches of up to `batch_bytes` (one task per
+#     batch), so the pickling/IPC round trip is paid once per batch instead
+#     of once per 200-byte file;
+# -   marks files above `split_threshold` for block-parallel compression.
+#
+# After the run, the makespan (wall time) is compared with the ideal lower
+# bound max(total work / workers, longest single task): no schedule can
+# finish faster than that.
+#
+SMALL_FILE_THRESHOLD = 256 * 1024    # Files below this are batched together
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+
+
+class CompressionTask(NamedTuple):
+    """One unit of work submitted to the process pool."""
+    files: Tuple[str, ...]
+    total_bytes: int
+    split: bool = False  # Compress one large file in parallel blocks
+
+
+class ScheduleReport(NamedTuple):
+    """How close a run came to the best possible schedule."""
+    workers: int
+    tasks: int
+    total_bytes: int
+    makespan: float      # Measured wall time
+    work_seconds: float  # Sum of the compression times of all tasks
+    lower_bound: float   # max(work_seconds / workers, longest task)
 
+    @property
+    def efficiency(self) -> float:
+        """lower_bound / makespan: 1.0 means a perfect schedule."""
+        return self.lower_bound / self.makespan if self.makespan else 1.0
 
+    def __str__(self) -> str:
+        return (f"{self.tasks} tasks, {self.total_bytes} bytes on {self.workers} workers: "
+                f"makespan {self.makespan:.3f}s vs lower bound {self.lower_bound:.3f}s "
+                f"({self.efficiency:.0%} efficient)")
 
-async def async_copy_file(loop: asyncio.AbstractEventLoop, src_path: str, dest_path: str) -> None:
+
+def plan_compression_tasks(input_files: List[str],
+                           small_file_threshold: int = SMALL_FILE_THRESHOLD,
+                           batch_bytes: int = DEFAULT_BATCH_BYTES,
+                           split_threshold: Optional[int] = None) -> List[CompressionTask]:
     """
-    Asynchronously copies a file using a thread.
+    Stats the inputs and builds a largest-first list of tasks.
 
     Args:
-        loop: The asyncio event loop.
-        src_path: Path to the source file.
-        dest_path: Path to the destination file.
+        input_files: Paths of the files to compress.
+        small_file_threshold: Files smaller than this are batched.
+        batch_bytes: Maximum total size of one batch of small files.
+        split_threshold: Files larger than this are marked for block-parallel
+            compression (None: never split).
+
+    Returns:
+        Tasks sorted by total size, largest first.  Files that cannot be
+        stat'ed are reported and left out.
     """
-    def copy_sync():
-        """Synchronous file copy operation."""
+    sizes = []
+    for input_file in input_files:
         try:
-            # Use shutil.copy for the actual file copy
-            import shutil
-            shutil.copy(src_path, dest_path)
-            print(f"Copied {src_path} to {dest_path} in thread")
-        except Exception as e:
-            print(f"Error copying {src_path} to {dest_path}: {e}")
+            sizes.append((os.path.getsize(input_file), input_file))
+        except OSError as e:
+            print(f"Skipping {input_file}: {e}")
+    sizes.sort(reverse=True)
+
+    tasks = []
+    batch, batch_total = [], 0
+    for size, input_file in sizes:
+        if size >= small_file_threshold:
+            split = split_threshold is not None and size > split_threshold
+            tasks.append(CompressionTask((input_file,), size, split))
+            continue
+        if batch and batch_total + size > batch_bytes:
+            tasks.append(CompressionTask(tuple(batch), batch_total))
+            batch, batch_total = [], 0
+        batch.append(input_file)
+        batch_total += size
+    if batch:
+        tasks.append(CompressionTask(tuple(batch), batch_total))
+    tasks.sort(key=lambda task: task.total_bytes, reverse=True)
+    return tasks
+
+
+def compress_batch(input_files: Tuple[str, ...], output_dir: str,
+                   level: Optional[int] = None,
+                   buffer_size: int = DEFAULT_BUFFER_SIZE,
+                   codec: str = DEFAULT_CODEC,
+                   root: Optional[str] = None,
+                   hash_content: bool = False) -> List[Optional[CompressionResult]]:
+    """
+    Compresses several (small) files in one worker call.
+    This function is intended to be run in a separate process.
+    """
+    return [compress_file(input_file, output_dir, level, buffer_size, codec, root, hash_content)
+            for input_file in input_files]
+
+
+def schedule_report(tasks: List[CompressionTask], results: List[List[Optional[CompressionResult]]],
+                    workers: int, makespan: float) -> ScheduleReport:
+    """
+    Compares the measured makespan with the ideal lower bound.
+
+    A split file contributes the worker time of each of its blocks; its
+    longest indivisible piece is its slowest block, not the whole file.
+    """
+    work_seconds = 0.0
+    longest = 0.0
+    for task_results in results:
+        task_seconds = 0.0
+        for r in task_results:
+            if r is None:
+                continue
+            if r.block_seconds:
+                work_seconds += sum(r.block_seconds)
+                longest = max(longest, max(r.block_seconds))
+            else:
+                task_seconds += r.seconds
+        work_seconds += task_seconds
+        longest = max(longest, task_seconds)
+    lower_bound = max(work_seconds / workers, longest)
+    return ScheduleReport(workers, len(tasks), sum(t.total_bytes for t in tasks),
+                          makespan, work_seconds, lower_bound)
+
+
+
+# -----------------------------------------------------------------------------
+# Incremental Runs: Skipping Unchanged Files
+# -----------------------------------------------------------------------------
+#
+# A nightly archival job over a mostly unchanged tree should not recompress
+# everything.  With `incremental=True`, `parallel_compress_files` keeps a
+# manifest (`.compress_manifest.json` in the output directory) with one entry
+# per input:
+#
+#   {"/data/app.log": {"size": 1048576, "mtime_ns": 1718000000000000000,
+#                      "hash": "9f2c...", "codec": "gzip", "level": 6,
+#                      "output_file": "/archive/app.log.gz", "output_bytes": 98304}}
+#
+# An input is skipped, and its existing output reused, when:
+#
+# -   codec and level are unchanged and the output still exists with the
+#     recorded size, and
+# -   size and mtime match the manifest (no file content is read at all), or
+# -   with `hash_content=True`: the size matches and the content hash matches,
+#     even though the mtime changed (a `touch`, a restore from backup, a
+#     checkout that rewrote identical files).
+#
+# The hash is computed by the worker while it streams the file for
+# compression, so it costs no extra read for files that are compressed.
+# xxHash (`xxhash` package) is used when installed, otherwise BLAKE2b from
+# `hashlib`; both are much faster than the disk.  The manifest is saved
+# atomically (temporary file + rename) after every run.
+#
+MANIFEST_FILE = ".compress_manifest.json"
+
+try:
+    import xxhash
+    HASH_ALGORITHM = "xxh3_128"
+    _new_hasher = xxhash.xxh3_128
+except ImportError:
+    HASH_ALGORITHM = "blake2b-128"
+    _new_hasher = lambda: hashlib.blake2b(digest_size=16)
+
+
+def file_digest(path: str, buffer_size: int = DEFAULT_BUFFER_SIZE) -> str:
+    """Returns the content hash of a file ("<algorithm>:<hex digest>")."""
+    hasher = _new_hasher()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return f"{HASH_ALGORITHM}:{hasher.hexdigest()}"
+
 
-    # Use loop.run_in_executor to run the synchronous copy in a thread
-    await loop.run_in_executor(None, copy_sync)
+def load_manifest(output_dir: str) -> Dict[str, dict]:
+    """Loads the manifest of a previous run (empty if there is none)."""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir: str, manifest: Dict[str, dict]) -> None:
+    """Writes the manifest atomically."""
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    tmp_path = _temporary_path(path)
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def is_unchanged(input_file: str, entry: Optional[dict], codec: str, level: int,
+                 hash_content: bool = False) -> bool:
+    """Decides whether the output recorded in `entry` is still valid."""
+    if not entry or entry.get("codec") != codec or entry.get("level") != level:
+        return False
+    try:
+        stat = os.stat(input_file)
+        if os.path.getsize(entry["output_file"]) != entry["output_bytes"]:
+            return False
+    except OSError:
+        return False
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    # Same size, new mtime: only the content can tell.
+    if hash_content and entry.get("hash"):
+        if file_digest(input_file) == entry["hash"]:
+            entry["mtime_ns"] = stat.st_mtime_ns  # Remember the new mtime
+            return True
+    return False
+
+
+class IncrementalStats(NamedTuple):
+    """What an incremental run skipped versus compressed."""
+    skipped_files: int
+    skipped_bytes: int
+    compressed_files: int
+    compressed_bytes: int
 
+    def __str__(self) -> str:
+        total = self.skipped_bytes + self.compressed_bytes
+        share = self.skipped_bytes / total if total else 0.0
+        return (f"skipped {self.skipped_files} unchanged files ({self.skipped_bytes} bytes, "
+                f"{share:.0%}), compressed {self.compressed_files} files "
+                f"({self.compressed_bytes} bytes)")
 
 
-async def parallel_compress_files(input_files: List[str]) -> List[str]:
+
+async def parallel_compress_files(input_files: List[str],
+                                  output_dir: str,
+                                  level: Optional[int] = None,
+                                  buffer_size: int = DEFAULT_BUFFER_SIZE,
+                                  split_threshold: Optional[int] = None,
+                                  block_size: int = DEFAULT_BLOCK_SIZE,
+                                  max_workers: Optional[int] = None,
+                                  small_file_threshold: int = SMALL_FILE_THRESHOLD,
+                                  batch_bytes: int = DEFAULT_BATCH_BYTES,
+                                  codec: str = DEFAULT_CODEC,
+                                  root: Optional[str] = None,
+                                  incremental: bool = False,
+                                  hash_content: bool = False,
+                                  max_pending: Optional[int] = None,
+                                  metrics_file: Optional[str] = None,
+                                  metrics_interval: Optional[float] = None
+                                  ) -> List[CompressionResult]:
     """
     Compresses multiple files in parallel using multiprocessing and asyncio.
 
+    Work is scheduled largest-first, with small files batched into shared
+    tasks (see `plan_compression_tasks`).  Output is streamed straight into
+    `output_dir` and each file appears there atomically when complete.
+
     Args:
         input_files: A list of paths to the files to compress.
+        output_dir: Destination directory (created if missing).
+        level: Compression level (default: the codec's default level).
+        buffer_size: Read size used when streaming each input file.
+        split_threshold: Files larger than this many bytes are split into
+            `block_size` blocks compressed in parallel (None: never split;
+            ignored for codecs whose streams cannot be concatenated).
+        block_size: Block size used for split files.
+        max_workers: Number of worker processes (default: CPU count).
+        small_file_threshold: Files smaller than this are batched.
+        batch_bytes: Maximum total size of one batch of small files.
+        codec: Name of a codec in `CODECS` (see `recommend_codec`).
+        root: If given, the directory layout below `root` is mirrored in
+            `output_dir`; otherwise all outputs go directly into `output_dir`.
+        incremental: Skip inputs that are unchanged since the last run into
+            `output_dir` and reuse their outputs (see `is_unchanged`).
+        hash_content: With `incremental`, record content hashes and use them
+            to detect unchanged files whose mtime changed.
+        max_pending: Maximum number of tasks submitted to the pool at once
+            (default: twice `max_workers`).  For unbounded streams of files
+            use `pipelined_compress_files`.
+        metrics_file: Where to export the run's metrics as JSON (see
+            `CompressionMetrics`).
+        metrics_interval: Also export them every this many seconds.
 
     Returns:
-        A list of paths to the compressed files.
+        A CompressionResult (path, sizes, timing) for each compressed file.
     """
-    compressed_files = []
-    # Create a temporary directory.
-    with tempfile.TemporaryDirectory() as temp_dir:
-        print(f"Using temporary directory: {temp_dir}")
-        loop = asyncio.get_event_loop()
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * max_workers
+    if not get_codec(codec).concatenable:
+        split_threshold = None
+    destinations = [output_path(f, output_dir, codec, root) for f in input_files]
+    if len(set(destinations)) != len(destinations):
+        raise ValueError("Several inputs map to the same output file; "
+                         "pass root= to mirror the input directory layout")
+    os.makedirs(output_dir, exist_ok=True)
+    resolved_level = get_codec(codec).default_level if level is None else level
+
+    reused = []
+    to_compress = input_files
+    manifest = load_manifest(output_dir) if incremental else {}
+    if incremental:
+        to_compress = []
+        for input_file in input_files:
+            entry = manifest.get(os.path.abspath(input_file))
+            if is_unchanged(input_file, entry, codec, resolved_level, hash_content):
+                reused.append(CompressionResult(input_file, entry["output_file"], entry["size"],
+                                                entry["output_bytes"], 0.0,
+                                                content_hash=entry.get("hash"), skipped=True))
+            else:
+                to_compress.append(input_file)
+        # Stat before compressing: a file modified mid-run gets a stale mtime
+        # in the manifest and is therefore recompressed next time.
+        stats_before = {}
+        for input_file in to_compress:
+            try:
+                stats_before[input_file] = os.stat(input_file)
+            except OSError:
+                pass
+
+    tasks = plan_compression_tasks(to_compress, small_file_threshold, batch_bytes,
+                                   split_threshold)
+    loop = asyncio.get_running_loop()
+
+    async def compress_large_file(input_file, executor):
+        """Block-parallel compression, reporting errors like compress_file."""
+        output_file = output_path(input_file, output_dir, codec, root)
+        try:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            result = await parallel_compress_large_file(input_file, output_file, level,
+                                                        block_size, executor, codec=codec)
+            if hash_content and incremental:
+                # Blocks are read out of order by the workers; hash separately.
+                # Only the manifest uses the hash, so skip the second read
+                # of the file when there is none.
+                result = result._replace(content_hash=await asyncio.to_thread(file_digest, input_file))
+            return [result]
+        except Exception as e:
+            print(f"Error compressing {input_file} in blocks: {e}")
+            return [None]
 
+    start_time = time.perf_counter()
+    metrics = CompressionMetrics(max_workers)
+    exporter = (asyncio.create_task(metrics.export_periodically(metrics_file, metrics_interval))
+                if metrics_file and metrics_interval else None)
+    try:
         # Create a process pool.
-        with concurrent.futures.ProcessPoolExecutor() as executor:
-            # Submit the compression tasks to the process pool.
-            futures = [
-                loop.run_in_executor(executor, compress_file, input_file, temp_dir)
-                for input_file in input_files
-            ]
-            # Wait for the compression tasks to complete.
-            completed_files = await asyncio.gather(*futures)
+        with metrics.executor() as executor:
+            # Submit the compression tasks to the process pool, largest first,
+            # keeping at most `max_pending` of them submitted at a time.
+            completed_tasks = []
+            running = set()
+            for task in tasks:
+                if len(running) >= max_pending:
+                    done, running = await asyncio.wait(running,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                    completed_tasks.extend(future.result() for future in done)
+                if task.split:
+                    future = asyncio.ensure_future(compress_large_file(task.files[0], executor))
+                else:
+                    future = loop.run_in_executor(executor, compress_batch, task.files,
+                                                  output_dir, level, buffer_size, codec, root,
+                                                  hash_content and incremental)
+                running.add(future)
+                metrics.observe_queue("pending tasks", len(running))
+            # Wait for the remaining compression tasks to complete.
+            if running:
+                done, _ = await asyncio.wait(running)
+                completed_tasks.extend(future.result() for future in done)
+    finally:
+        if exporter:
+            exporter.cancel()
+        snapshot = metrics.export(metrics_file) if metrics_file else metrics.snapshot()
+        metrics.close()
+    print(schedule_report(tasks, completed_tasks, max_workers,
+                          time.perf_counter() - start_time))
+    print(CompressionMetrics.summary(snapshot))
+
+    compressed_files = [result for task_results in completed_tasks
+                        for result in task_results if result is not None]
+
+    if incremental:
+        for result in compressed_files:
+            stat = stats_before.get(result.input_file)
+            if stat is None:
+                continue
+            manifest[os.path.abspath(result.input_file)] = {
+                "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": result.content_hash,
+                "codec": codec, "level": resolved_level,
+                "output_file": os.path.abspath(result.output_file),
+                "output_bytes": result.output_bytes,
+            }
+        save_manifest(output_dir, manifest)
+        print(IncrementalStats(len(reused), sum(r.input_bytes for r in reused),
+                               len(compressed_files), sum(r.input_bytes for r in compressed_files)))
+    compressed_files += reused
+
+    # Report results in input order, not scheduling order.
+    position = {input_file: i for i, input_file in enumerate(input_files)}
+    compressed_files.sort(key=lambda result: position[result.input_file])
+    print("All files compressed.")
+    return compressed_files
+
+
+
+# -----------------------------------------------------------------------------
+# Bounded Pipeline: Read -> Compress -> Write
+# -----------------------------------------------------------------------------
+#
+# `parallel_compress_files` stats and plans every input up front, which is
+# what LPT scheduling needs, but it means holding the whole file list and one
+# future per task.  For a million files (or an endless stream of them) the
+# work has to flow through fixed-size stages instead:
+#
+#   input_files --> [reader] --q1--> [compress x N] --q2--> [writer] --> .gz
+#      (lazy)       threads   bounded   process pool  bounded  threads
+#                                \______ in-flight byte budget ______/
+#
+# -   The reader consumes `input_files` lazily (any iterable, e.g. a
+#     generator over `os.scandir`) and reads each file in blocks.
+# -   N compression coroutines take blocks off the first queue and compress
+#     them in the process pool, one block per worker call.
+# -   The writer appends each block's compressed member to its file (blocks
+#     of one file are written in order) and renames the file into place once
+#     its last block is written.
+#
+# Every queue is bounded (`queue_size`), and every block holds a share of
+# `max_in_flight_bytes` from the moment it is read until its compressed bytes
+# are written.  When compression or writing falls behind, the reader blocks,
+# so memory stays at about `max_in_flight_bytes` however many files there are.
+#
+# Each stage records how long it was busy and how long it was blocked waiting
+# for the next stage; the report shows which stage is the bottleneck:
+#
+#   stage      items        bytes     busy  blocked  util  max queue
+#   read          40    335544320    0.21s    2.63s    7%          -
+#   compress      40    335544320   11.02s    0.01s   96%         16
+#   write         40     10747904    0.04s    0.00s    1%          3
+#
+# ("max queue" is the deepest the queue feeding the stage got.)
+#
+# Non-concatenable codecs (zlib) cannot be split into members, so each file
+# is read and compressed as one block.
+#
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_IN_FLIGHT_BYTES = 256 * 1024 * 1024
+
+
+def compress_chunk(data: bytes, level: Optional[int] = None,
+                   codec: str = DEFAULT_CODEC) -> Tuple[bytes, float]:
+    """
+    Compresses one block of data into one member of `codec`.
+    This function is intended to be run in a separate process.
+
+    Returns:
+        The compressed member and the seconds spent compressing it.
+    """
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    codec_info = get_codec(codec)
+    member = codec_info.compress(data, codec_info.default_level if level is None else level)
+    seconds = time.perf_counter() - start_time
+    record_work(len(data), len(member), seconds, time.process_time() - start_cpu)
+    return member, seconds
+
+
+class ByteBudget:
+    """An asyncio semaphore counted in bytes."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, n: int) -> None:
+        """Waits until `n` more bytes fit (a single oversized item is let through alone)."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.used == 0 or self.used + n <= self.limit)
+            self.used += n
+            self.peak = max(self.peak, self.used)
+
+    async def release(self, n: int) -> None:
+        async with self._condition:
+            self.used -= n
+            self._condition.notify_all()
+
+
+class StageStats:
+    """Counters of one pipeline stage (mutable, updated by the stage itself)."""
+    def __init__(self, name: str, workers: int = 1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0     # Doing the stage's own work
+        self.blocked_seconds = 0.0  # Waiting for room downstream
+        self.max_queue_depth = None  # Deepest the stage's input queue got
+
+    def utilization(self, wall_seconds: float) -> float:
+        """Fraction of the stage's capacity (wall time x workers) spent busy."""
+        return self.busy_seconds / (wall_seconds * self.workers) if wall_seconds else 0.0
+
+
+class PipelineReport(NamedTuple):
+    """Per-stage metrics of one `pipelined_compress_files` run."""
+    stages: Tuple[StageStats, ...]
+    wall_seconds: float
+    peak_in_flight_bytes: int
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':<10} {'items':>5} {'bytes':>12} {'busy':>8} {'blocked':>8} "
+                 f"{'util':>5} {'max queue':>10}"]
+        for s in self.stages:
+            depth = "-" if s.max_queue_depth is None else s.max_queue_depth
+            lines.append(f"{s.name:<10} {s.items:>5} {s.bytes:>12} {s.busy_seconds:>7.2f}s "
+                         f"{s.blocked_seconds:>7.2f}s {s.utilization(self.wall_seconds):>5.0%} "
+                         f"{depth:>10}")
+        lines.append(f"wall {self.wall_seconds:.2f}s, peak in flight "
+                     f"{self.peak_in_flight_bytes} bytes")
+        return "\n".join(lines)
+
+
+class _Block(NamedTuple):
+    """One block travelling through the pipeline."""
+    file_id: int
+    index: int                     # Position of the block within its file
+    data: Optional[bytes]          # Uncompressed (queue 1) or compressed (queue 2) bytes
+    reserved: int                  # Bytes held in the budget for this block
+    final: bool                    # Last block of its file
+    failed: bool = False           # Reading or compressing the block failed
+    slot: Optional[int] = None     # Shared memory slot holding the data instead
+    length: int = 0                # Bytes in the slot
+
+
+async def pipelined_compress_files(input_files: Iterable[str],
+                                   output_dir: str,
+                                   level: Optional[int] = None,
+                                   block_size: int = DEFAULT_BLOCK_SIZE,
+                                   max_workers: Optional[int] = None,
+                                   compress_concurrency: Optional[int] = None,
+                                   queue_size: int = DEFAULT_QUEUE_SIZE,
+                                   max_in_flight_bytes: int = DEFAULT_IN_FLIGHT_BYTES,
+                                   codec: str = DEFAULT_CODEC,
+                                   root: Optional[str] = None,
+                                   use_shared_memory: bool = False,
+                                   metrics_file: Optional[str] = None,
+                                   metrics_interval: Optional[float] = None
+                                   ) -> Tuple[List[CompressionResult], PipelineReport]:
+    """
+    Compresses a stream of files through bounded read/compress/write stages.
+
+    Args:
+        input_files: Paths of the files to compress (consumed lazily).
+        output_dir: Destination directory (created if needed).
+        level: Compression level (default: the codec's default level).
+        block_size: Uncompressed bytes per block; blocks of one file become
+            separate members of its output.
+        max_workers: Number of compression processes (default: CPU count).
+        compress_concurrency: Blocks being compressed at once (default: twice
+            `max_workers`, so no worker waits for its next block).
+        queue_size: Capacity of each queue between stages, in blocks.
+        max_in_flight_bytes: Maximum uncompressed bytes read but not yet
+            written.
+        codec: Name of a codec in `CODECS`.
+        root: If given, the directory layout below `root` is mirrored in
+            `output_dir`.
+        use_shared_memory: Hand blocks to the workers through a `SharedBufferRing`
+            instead of pickling them (concatenable codecs only).
+        metrics_file: Where to export the workers' metrics as JSON (see
+            `CompressionMetrics`).
+        metrics_interval: Also export them every this many seconds.
+
+    Returns:
+        A CompressionResult per compressed file (in completion order) and the
+        per-stage PipelineReport.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    compress_concurrency = compress_concurrency or 2 * max_workers
+    split = get_codec(codec).concatenable
+    if use_shared_memory and not split:
+        raise ValueError(f"Codec {codec!r} needs whole files as one block; "
+                         f"it cannot use fixed-size shared memory slots")
+    ring = (SharedBufferRing(max(1, max_in_flight_bytes // block_size), block_size)
+            if use_shared_memory else None)
+    loop = asyncio.get_running_loop()
+    budget = ByteBudget(max_in_flight_bytes)
+    read_queue: asyncio.Queue = asyncio.Queue(queue_size)
+    write_queue: asyncio.Queue = asyncio.Queue(queue_size)
+    read_stats = StageStats("read")
+    compress_stats = StageStats("compress", max_workers)
+    write_stats = StageStats("write")
+    compress_stats.max_queue_depth = write_stats.max_queue_depth = 0
+    files: Dict[int, dict] = {}  # file_id -> state shared by reader and writer
+    results: List[CompressionResult] = []
+
+    async def put(queue, item, stats, next_stats):
+        start = time.perf_counter()
+        await queue.put(item)
+        stats.blocked_seconds += time.perf_counter() - start
+        next_stats.max_queue_depth = max(next_stats.max_queue_depth, queue.qsize())
+        metrics.observe_queue(f"{next_stats.name} queue", queue.qsize())
+
+    async def read_file(file_id, input_file):
+        try:
+            src = await asyncio.to_thread(open, input_file, "rb")
+        except OSError as e:
+            print(f"Skipping {input_file}: {e}")
+            return
+        with src:
+            size = os.fstat(src.fileno()).st_size
+            chunk = block_size if split else size
+            files[file_id] = {"input_file": input_file, "start": time.perf_counter(),
+                              "input_bytes": 0}
+            index = 0
+            while True:
+                start = time.perf_counter()
+                await budget.acquire(chunk)
+                slot = await ring.free.get() if ring else None
+                read_stats.blocked_seconds += time.perf_counter() - start
+                start = time.perf_counter()
+                try:
+                    if ring:
+                        data = None
+                        with ring.input_view(slot, chunk) as view:
+                            length = await asyncio.to_thread(src.readinto, view)
+                    else:
+                        data = await asyncio.to_thread(src.read, chunk)
+                        length = len(data)
+                except OSError as e:
+                    print(f"Error reading {input_file}: {e}")
+                    await budget.release(chunk)
+                    # Tell the writer to drop what it has of this file.
+                    await put(read_queue, _Block(file_id, index, None, 0, True, True, slot),
+                              read_stats, compress_stats)
+                    return
+                read_stats.busy_seconds += time.perf_counter() - start
+                await budget.release(chunk - length)
+                # A short read means end of file; a full one may be followed
+                # by an empty block, which still yields a valid empty member.
+                final = length < chunk or not split
+                read_stats.items += 1
+                read_stats.bytes += length
+                files[file_id]["input_bytes"] += length
+                await put(read_queue, _Block(file_id, index, data, length, final, slot=slot,
+                                             length=length), read_stats, compress_stats)
+                if final:
+                    return
+                index += 1
+
+    async def reader():
+        seen = set()
+        for file_id, input_file in enumerate(input_files):
+            destination = output_path(input_file, output_dir, codec, root)
+            if destination in seen:
+                print(f"Skipping {input_file}: {destination} is already an output of this run")
+                continue
+            seen.add(destination)
+            await read_file(file_id, input_file)
+        for _ in range(compress_concurrency):
+            await read_queue.put(None)
+
+    async def compressor():
+        while True:
+            block = await read_queue.get()
+            if block is None:
+                break
+            if block.failed:
+                await put(write_queue, block, compress_stats, write_stats)
+                continue
+            try:
+                if ring:
+                    length, member, seconds = await loop.run_in_executor(
+                        executor, compress_slot, ring.name, ring.input_offset(block.slot),
+                        block.length, ring.output_offset(block.slot), ring.output_size,
+                        level, codec)
+                    done = block._replace(data=member, length=length)
+                else:
+                    member, seconds = await loop.run_in_executor(executor, compress_chunk,
+                                                                 block.data, level, codec)
+                    done = block._replace(data=member, length=len(member))
+            except Exception as e:
+                print(f"Error compressing block {block.index} of "
+                      f"{files[block.file_id]['input_file']}: {e}")
+                done, seconds = block._replace(data=None, failed=True), 0.0
+            compress_stats.busy_seconds += seconds
+            compress_stats.items += 1
+            compress_stats.bytes += block.reserved
+            await put(write_queue, done, compress_stats, write_stats)
+
+    def write_block(state, block):
+        if "out" not in state:
+            output_file = output_path(state["input_file"], output_dir, codec, root)
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            state["output_file"] = output_file
+            state["tmp_file"] = _temporary_path(output_file)
+            state["output_bytes"] = 0
+            state["out"] = open(state["tmp_file"], "wb")
+        if block.data is None:
+            with ring.output_view(block.slot, block.length) as view:
+                state["out"].write(view)
+        else:
+            state["out"].write(block.data)
+        state["output_bytes"] += block.length
+        if block.final:
+            state.pop("out").close()
+            os.replace(state["tmp_file"], state["output_file"])
+
+    def discard_output(state):
+        out = state.pop("out", None)
+        if out is not None:
+            out.close()
+            os.remove(state["tmp_file"])
+
+    async def writer():
+        waiting: Dict[Tuple[int, int], _Block] = {}  # Blocks that arrived early
+        next_index: Dict[int, int] = {}
+        while True:
+            block = await write_queue.get()
+            if block is None:
+                break
+            waiting[block.file_id, block.index] = block
+            # Write every block of this file that is now next in line.
+            while (block.file_id, next_index.get(block.file_id, 0)) in waiting:
+                b = waiting.pop((block.file_id, next_index.get(block.file_id, 0)))
+                next_index[b.file_id] = b.index + 1
+                state = files[b.file_id]
+                start = time.perf_counter()
+                if b.failed:
+                    state["failed"] = True
+                if not state.get("failed"):
+                    try:
+                        await asyncio.to_thread(write_block, state, b)
+                        write_stats.bytes += b.length
+                        if b.final:
+                            results.append(CompressionResult(
+                                state["input_file"], state["output_file"], state["input_bytes"],
+                                state["output_bytes"], time.perf_counter() - state["start"]))
+                    except OSError as e:
+                        print(f"Error writing {state['input_file']}: {e}")
+                        state["failed"] = True
+                if state.get("failed"):
+                    await asyncio.to_thread(discard_output, state)
+                write_stats.busy_seconds += time.perf_counter() - start
+                write_stats.items += 1
+                if b.slot is not None:
+                    ring.free.put_nowait(b.slot)
+                await budget.release(b.reserved)
+                if b.final:
+                    del files[b.file_id], next_index[b.file_id]
+
+    start_time = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    metrics = CompressionMetrics(max_workers)
+    exporter = (asyncio.create_task(metrics.export_periodically(metrics_file, metrics_interval))
+                if metrics_file and metrics_interval else None)
+    try:
+        with metrics.executor() as executor:
+            write_task = asyncio.create_task(writer())
+            compress_tasks = [asyncio.create_task(compressor())
+                              for _ in range(compress_concurrency)]
+            try:
+                await reader()
+                await asyncio.gather(*compress_tasks)
+                await write_queue.put(None)
+                await write_task
+            finally:
+                for task in compress_tasks + [write_task]:
+                    task.cancel()
+                for state in files.values():
+                    discard_output(state)
+                if ring:
+                    ring.close()
+    finally:
+        if exporter:
+            exporter.cancel()
+        if metrics_file:
+            metrics.export(metrics_file)
+        metrics.close()
+    report = PipelineReport((read_stats, compress_stats, write_stats),
+                            time.perf_counter() - start_time, budget.peak)
+    return results, report
+
+
+
+# -----------------------------------------------------------------------------
+# Zero-Copy Handoff Through Shared Memory
+# -----------------------------------------------------------------------------
+#
+# In the pipeline above each block crosses the process boundary twice as a
+# pickled `bytes` object: the uncompressed block goes to the worker and the
+# compressed member comes back.  Each crossing is a copy into the pipe, a copy
+# out of it and a fresh allocation, so for fast codecs (lz4, zstd -1, gzip -1)
+# the IPC costs about as much as the compression.
+#
+# With `use_shared_memory=True` the pipeline allocates a ring of slots in one
+# `multiprocessing.shared_memory` segment that is mapped by the parent and
+# every worker:
+#
+#   segment:  | in 0 | out 0 | in 1 | out 1 | ... | in N-1 | out N-1 |
+#
+#   reader:   takes a free slot, `readinto()`s the block directly into "in"
+#   worker:   compresses straight from "in" (a memoryview, no copy) and
+#             writes the member into "out"
+#   writer:   writes "out" to the file and returns the slot to the free list
+#
+# Only the slot offsets and lengths are pickled.  The number of slots
+# (`max_in_flight_bytes // block_size`) bounds the memory in use.  An "out"
+# slot holds the worst-case compressed size of a block; a member that somehow
+# does not fit is returned the normal, pickled way.
+#
+# Workers attach to the segment once and cache the mapping
+# (`_attached_segments`).  The parent owns the segment and unlinks it when
+# the run ends, also on errors.
+#
+def max_compressed_size(n: int) -> int:
+    """Upper bound of the compressed size of `n` bytes for all `CODECS`."""
+    # Incompressible data grows by at most ~0.5% (bz2) plus small headers.
+    return n + n // 64 + 64 * 1024
+
+
+class SharedBufferRing:
+    """Input/output slot pairs in one shared memory segment, handed out by the parent."""
+    def __init__(self, slots: int, slot_size: int):
+        self.slots = slots
+        self.slot_size = slot_size
+        self.output_size = max_compressed_size(slot_size)
+        self.stride = slot_size + self.output_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * self.stride)
+        self.name = self.shm.name
+        self.free: asyncio.Queue = asyncio.Queue()
+        for slot in range(slots):
+            self.free.put_nowait(slot)
+
+    def input_offset(self, slot: int) -> int:
+        return slot * self.stride
+
+    def output_offset(self, slot: int) -> int:
+        return slot * self.stride + self.slot_size
+
+    def input_view(self, slot: int, length: int) -> memoryview:
+        """Writable view of an input slot (release it when done)."""
+        offset = self.input_offset(slot)
+        return self.shm.buf[offset:offset + length]
+
+    def output_view(self, slot: int, length: int) -> memoryview:
+        """View of the first `length` bytes of an output slot (release it when done)."""
+        offset = self.output_offset(slot)
+        return self.shm.buf[offset:offset + length]
+
+    def close(self) -> None:
+        """Unmaps and deletes the segment."""
+        self.shm.close()
+        self.shm.unlink()
 
-        compressed_files = [file for file in completed_files if file is not None]
+    def __enter__(self):
+        return self
 
-        # Use asyncio.to_thread to copy the files
-        copy_tasks = []
-        for src, dest in zip(compressed_files, [os.path.join(temp_dir,os.path.basename(f)) for f in compressed_files]):
-            copy_tasks.append(asyncio.create_task(async_copy_file(loop, src, dest)))
-        await asyncio.gather(*copy_tasks)
-        print("All files compressed.")
-        return compressed_files
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_attached_segments: Dict[str, shared_memory.SharedMemory] = {}
+
+
+def compress_slot(segment: str, input_offset: int, length: int, output_offset: int,
+                  output_size: int, level: Optional[int] = None,
+                  codec: str = DEFAULT_CODEC) -> Tuple[int, Optional[bytes], float]:
+    """
+    Compresses a block from shared memory into shared memory.
+    This function is intended to be run in a separate process.
+
+    Returns:
+        The size of the compressed member, the member itself only if it did
+        not fit into the output slot (else None), and the seconds spent.
+    """
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    shm = _attached_segments.get(segment)
+    if shm is None:
+        shm = _attached_segments[segment] = shared_memory.SharedMemory(name=segment)
+    codec_info = get_codec(codec)
+    with shm.buf[input_offset:input_offset + length] as data:
+        member = codec_info.compress(data, codec_info.default_level if level is None else level)
+    overflow = member if len(member) > output_size else None
+    if overflow is None:
+        shm.buf[output_offset:output_offset + len(member)] = member
+    seconds = time.perf_counter() - start_time
+    record_work(length, len(member), seconds, time.process_time() - start_cpu)
+    return len(member), overflow, seconds
+
+
+
+# -----------------------------------------------------------------------------
+# Restoring and Verifying Archives
+# -----------------------------------------------------------------------------
+#
+# A backup is only as good as the last restore that was tested.
+# `parallel_decompress_files` is the inverse of `parallel_compress_files`:
+# it decompresses many archives at once across processes, and with
+# `verify_only=True` it checks them without writing anything.
+#
+# Every archive is streamed through its codec's reader (the codec is known
+# from the file extension), in `buffer_size` pieces, so memory stays flat
+# however large the archive is.  Three checks are made on the way:
+#
+# -   the codec's own integrity check: gzip verifies the CRC-32 and length
+#     trailer of every member, bz2 a CRC per block, xz a CRC-64 / SHA-256;
+#     a truncated archive fails with "ended before the end-of-stream marker";
+# -   a CRC-32 of the decompressed stream is computed as it goes and reported,
+#     so restores can be compared across machines cheaply;
+# -   with `manifest` (see "Incremental Runs"), the decompressed size and the
+#     content hash recorded when the archive was made are compared with the
+#     restored data.  This catches what the codec cannot: an archive that is
+#     intact but belongs to a different version of the file.
+#
+# Restored files are written under a temporary name and renamed into place,
+# so a failed check never leaves a plausible-looking file behind.  The run
+# ends with a throughput report (MB/s of restored data) to compare against
+# the backup window.
+#
+class DecompressionResult(NamedTuple):
+    """The outcome of restoring or verifying one archive."""
+    archive: str
+    output_file: Optional[str]  # None in verify-only mode or on failure
+    compressed_bytes: int
+    output_bytes: int
+    seconds: float
+    crc32: int
+    content_hash: Optional[str] = None
+    error: Optional[str] = None  # None if every check passed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class RestoreReport(NamedTuple):
+    """Totals of one `parallel_decompress_files` run."""
+    archives: int
+    failures: int
+    compressed_bytes: int
+    output_bytes: int
+    wall_seconds: float
+
+    @property
+    def throughput(self) -> float:
+        """Restored (decompressed) MB per second of wall time."""
+        return self.output_bytes / 1e6 / self.wall_seconds if self.wall_seconds else 0.0
+
+    def __str__(self) -> str:
+        return (f"{self.archives} archives, {self.failures} failed: {self.compressed_bytes} -> "
+                f"{self.output_bytes} bytes in {self.wall_seconds:.2f}s "
+                f"({self.throughput:.1f} MB/s)")
+
+
+def codec_for_archive(archive: str) -> Codec:
+    """Finds the codec of an archive from its file extension."""
+    for codec_info in CODECS.values():
+        if archive.endswith(codec_info.extension):
+            return codec_info
+    raise ValueError(f"No codec in CODECS produces {archive!r}")
+
+
+def restore_path(archive: str, output_dir: str, root: Optional[str] = None) -> str:
+    """Where `archive` is restored to: its name without the codec extension."""
+    name = os.path.relpath(archive, root) if root else os.path.basename(archive)
+    return os.path.join(output_dir, name[:-len(codec_for_archive(archive).extension)])
+
+
+def decompress_file(archive: str, output_dir: Optional[str] = None,
+                    expected_size: Optional[int] = None,
+                    expected_hash: Optional[str] = None,
+                    buffer_size: int = DEFAULT_BUFFER_SIZE,
+                    root: Optional[str] = None) -> DecompressionResult:
+    """
+    Decompresses one archive, checking it as it streams.
+    This function is intended to be run in a separate process.
+
+    Args:
+        archive: Path of the compressed file.
+        output_dir: Where to restore it (None: verify only, write nothing).
+        expected_size: Size of the original file, if known.
+        expected_hash: Content hash of the original file ("<algorithm>:<hex>"
+            as produced by `file_digest`), if known.
+        buffer_size: Decompressed bytes processed per iteration.
+        root: If given, the layout below `root` is mirrored in `output_dir`.
+
+    Returns:
+        A DecompressionResult; failures are reported in its `error` field,
+        never raised.
+    """
+    start_time = time.perf_counter()
+    crc = 0
+    output_bytes = 0
+    compressed_bytes = 0
+    tmp_file = None
+    hasher = None
+    if expected_hash is not None and expected_hash.startswith(HASH_ALGORITHM + ":"):
+        hasher = _new_hasher()
+    try:
+        codec_info = codec_for_archive(archive)
+        compressed_bytes = os.path.getsize(archive)
+        output_file = restore_path(archive, output_dir, root) if output_dir else None
+        if output_file:
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            tmp_file = _temporary_path(output_file)
+        with open(archive, "rb") as raw, codec_info.open_reader(raw) as reader, \
+                open(tmp_file or os.devnull, "wb") as out:
+            while True:
+                chunk = reader.read(buffer_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                output_bytes += len(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                if tmp_file:
+                    out.write(chunk)
+        content_hash = f"{HASH_ALGORITHM}:{hasher.hexdigest()}" if hasher is not None else None
+        if expected_size is not None and output_bytes != expected_size:
+            raise ValueError(f"size {output_bytes} != {expected_size} recorded in the manifest")
+        if expected_hash is not None and content_hash is None:
+            raise ValueError(f"cannot check {expected_hash.split(':')[0]} hash "
+                             f"(this run uses {HASH_ALGORITHM})")
+        if content_hash != expected_hash:
+            raise ValueError(f"content hash {content_hash} != {expected_hash} recorded in the manifest")
+        if tmp_file:
+            os.replace(tmp_file, output_file)
+            tmp_file = None
+        return DecompressionResult(archive, output_file, compressed_bytes, output_bytes,
+                                   time.perf_counter() - start_time, crc, content_hash)
+    except Exception as e:  # Corrupt data raises OSError, EOFError, zlib.error, lzma.LZMAError...
+        return DecompressionResult(archive, None, compressed_bytes, output_bytes,
+                                   time.perf_counter() - start_time, crc,
+                                   error=f"{type(e).__name__}: {e}")
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+async def parallel_decompress_files(archives: List[str],
+                                    output_dir: Optional[str] = None,
+                                    verify_only: bool = False,
+                                    manifest: Optional[Dict[str, dict]] = None,
+                                    buffer_size: int = DEFAULT_BUFFER_SIZE,
+                                    max_workers: Optional[int] = None,
+                                    max_pending: Optional[int] = None,
+                                    root: Optional[str] = None
+                                    ) -> Tuple[List[DecompressionResult], RestoreReport]:
+    """
+    Restores (or verifies) many archives in parallel.
+
+    Args:
+        archives: Paths of the compressed files.
+        output_dir: Destination of the restored files (ignored with
+            `verify_only`).
+        verify_only: Decompress and check, but write nothing.
+        manifest: A manifest from `load_manifest`; archives listed in it are
+            checked against the recorded size and content hash.
+        buffer_size: Decompressed bytes processed per iteration.
+        max_workers: Number of worker processes (default: CPU count).
+        max_pending: Maximum number of archives submitted at once (default:
+            twice `max_workers`).
+        root: If given, the layout below `root` is mirrored in `output_dir`.
+
+    Returns:
+        A DecompressionResult per archive (in input order) and a RestoreReport.
+    """
+    if not verify_only and output_dir is None:
+        raise ValueError("output_dir is required unless verify_only=True")
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * max_workers
+    destination = None if verify_only else output_dir
+    # The manifest is keyed by input file; look its entries up by archive.
+    originals = {entry["output_file"]: entry for entry in (manifest or {}).values()}
+    loop = asyncio.get_running_loop()
+
+    start_time = time.perf_counter()
+    results = []
+    running = set()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for archive in archives:
+            if len(running) >= max_pending:
+                done, running = await asyncio.wait(running,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            original = originals.get(os.path.abspath(archive), {})
+            running.add(loop.run_in_executor(executor, decompress_file, archive, destination,
+                                             original.get("size"), original.get("hash"),
+                                             buffer_size, root))
+        if running:
+            done, _ = await asyncio.wait(running)
+            results.extend(future.result() for future in done)
+    wall_seconds = time.perf_counter() - start_time
+
+    for r in results:
+        if not r.ok:
+            print(f"FAILED {r.archive}: {r.error}")
+    position = {archive: i for i, archive in enumerate(archives)}
+    results.sort(key=lambda result: position[result.archive])
+    report = RestoreReport(len(results), sum(not r.ok for r in results),
+                           sum(r.compressed_bytes for r in results),
+                           sum(r.output_bytes for r in results), wall_seconds)
+    return results, report
+
+
+
+# -----------------------------------------------------------------------------
+# Metrics Shared Across Processes
+# -----------------------------------------------------------------------------
+#
+# Printing a line per file from every worker serializes the workers on the
+# shared stdout pipe and still gives no numbers.  Sending an event to the
+# parent per file would be just as bad: one IPC round trip per 200-byte file.
+#
+# Instead every worker owns one row of counters in a small shared memory
+# segment:
+#
+#   row = [pid, started, items, errors, bytes_in, bytes_out, busy_s, cpu_s,
+#          latency bucket 0, ..., latency bucket 15]
+#
+# A worker updates only its own row (a single `struct.pack_into` per item, no
+# locks and no messages), and the parent reads all rows whenever it wants a
+# snapshot.  An "item" is one compressed file, or one block of a file that is
+# compressed in blocks.
+#
+# The snapshot (`CompressionMetrics.snapshot`, exported as JSON by `export`)
+# contains:
+#
+# -   bytes in/out, ratio and throughput;
+# -   a latency histogram with power-of-two buckets ("<=1ms", "<=2ms", ...,
+#     "<=16384ms", ">16384ms");
+# -   worker busy and idle time, and how much of the busy time was CPU time:
+#     a CPU share near 100% means the run is CPU-bound (add workers or pick a
+#     faster codec/level), a low share means the workers wait for the disk;
+# -   depths of the parent's queues, sampled wherever work is queued.
+#
+# `parallel_compress_files` and `pipelined_compress_files` accept
+# `metrics_file` (where to write the JSON) and `metrics_interval` (seconds
+# between periodic exports; None exports once at the end).
+#
+LATENCY_BUCKETS = 16
+_METRIC_FIELDS = ("pid", "started", "items", "errors", "bytes_in", "bytes_out",
+                  "busy_seconds", "cpu_seconds")
+_ROW_LENGTH = len(_METRIC_FIELDS) + LATENCY_BUCKETS
+_ROW_FORMAT = f"{_ROW_LENGTH}d"
+
+_metrics_segment: Optional[shared_memory.SharedMemory] = None
+_metrics_row: Optional[List[float]] = None  # This worker's counters
+_metrics_offset = 0
+
+
+def _init_worker_metrics(segment: str, next_row) -> None:
+    """ProcessPoolExecutor initializer: claims this worker's row of counters."""
+    global _metrics_segment, _metrics_row, _metrics_offset
+    with next_row.get_lock():
+        row = next_row.value
+        next_row.value += 1
+    _metrics_segment = shared_memory.SharedMemory(name=segment)
+    _metrics_offset = row * struct.calcsize(_ROW_FORMAT)
+    _metrics_row = [0.0] * _ROW_LENGTH
+    _metrics_row[0] = os.getpid()
+    _metrics_row[1] = time.time()
+    struct.pack_into(_ROW_FORMAT, _metrics_segment.buf, _metrics_offset, *_metrics_row)
+
+
+def record_work(bytes_in: int, bytes_out: int, seconds: float, cpu_seconds: float,
+                error: bool = False) -> None:
+    """Adds one item to this worker's counters (a no-op outside a metrics pool)."""
+    if _metrics_row is None:
+        return
+    row = _metrics_row
+    row[2] += 1
+    row[3] += error
+    row[4] += bytes_in
+    row[5] += bytes_out
+    row[6] += seconds
+    row[7] += cpu_seconds
+    bucket = min(max(0, math.ceil(math.log2(seconds * 1000 + 1e-9))), LATENCY_BUCKETS - 1)
+    row[len(_METRIC_FIELDS) + bucket] += 1
+    struct.pack_into(_ROW_FORMAT, _metrics_segment.buf, _metrics_offset, *row)
+
+
+class CompressionMetrics:
+    """Parent side of the shared counters: creates them, reads and exports them."""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.start_time = time.time()
+        self._segment = shared_memory.SharedMemory(create=True,
+                                                   size=workers * struct.calcsize(_ROW_FORMAT))
+        self._segment.buf[:] = bytes(self._segment.size)
+        self._next_row = multiprocessing.Value("i", 0)
+        self._queues: Dict[str, List[int]] = {}  # name -> [samples, total, max]
+
+    def executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        """A process pool whose workers report into these counters."""
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker_metrics,
+            initargs=(self._segment.name, self._next_row))
+
+    def observe_queue(self, name: str, depth: int) -> None:
+        """Samples the depth of one of the parent's queues."""
+        stats = self._queues.setdefault(name, [0, 0, 0])
+        stats[0] += 1
+        stats[1] += depth
+        stats[2] = max(stats[2], depth)
+
+    def snapshot(self) -> dict:
+        """Aggregates all workers' counters into one JSON-ready dict."""
+        now = time.time()
+        wall = now - self.start_time
+        values = struct.unpack_from(f"{self.workers * _ROW_LENGTH}d", self._segment.buf)
+        rows = [values[i:i + _ROW_LENGTH] for i in range(0, len(values), _ROW_LENGTH)]
+        workers = []
+        for row in rows[:min(self._next_row.value, self.workers)]:
+            worker = dict(zip(_METRIC_FIELDS, row))
+            for field in ("pid", "items", "errors", "bytes_in", "bytes_out"):
+                worker[field] = int(worker[field])
+            worker["idle_seconds"] = max(0.0, now - worker.pop("started") - worker["busy_seconds"])
+            workers.append(worker)
+        totals = {field: sum(w[field] for w in workers)
+                  for field in ("items", "errors", "bytes_in", "bytes_out",
+                                "busy_seconds", "idle_seconds", "cpu_seconds")}
+        histogram = [sum(row[len(_METRIC_FIELDS) + b] for row in rows)
+                     for b in range(LATENCY_BUCKETS)]
+        labels = [f"<={2 ** b}ms" for b in range(LATENCY_BUCKETS - 1)]
+        labels.append(f">{2 ** (LATENCY_BUCKETS - 2)}ms")
+        # Timer granularity can put CPU time slightly above wall time.
+        cpu_share = (min(1.0, totals["cpu_seconds"] / totals["busy_seconds"])
+                     if totals["busy_seconds"] else 0.0)
+        return {
+            "wall_seconds": wall,
+            "workers": len(workers),
+            **totals,
+            "ratio": totals["bytes_out"] / totals["bytes_in"] if totals["bytes_in"] else 1.0,
+            "throughput_mb_s": totals["bytes_in"] / 1e6 / wall if wall else 0.0,
+            "utilization": totals["busy_seconds"] / (wall * self.workers) if wall else 0.0,
+            "cpu_share": cpu_share,
+            "bound": "cpu" if cpu_share >= 0.8 else "io",
+            "latency_histogram": {label: int(n) for label, n in zip(labels, histogram) if n},
+            "queues": {name: {"max": s[2], "mean": s[1] / s[0]}
+                       for name, s in self._queues.items()},
+            "per_worker": workers,
+        }
+
+    def export(self, path: str) -> dict:
+        """Writes a snapshot as JSON (atomically) and returns it."""
+        snapshot = self.snapshot()
+        tmp_path = _temporary_path(path)
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, path)
+        return snapshot
+
+    async def export_periodically(self, path: str, interval: float) -> None:
+        """Exports a snapshot every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.export, path)
+
+    def close(self) -> None:
+        self._segment.close()
+        self._segment.unlink()
+
+    @staticmethod
+    def summary(snapshot: dict) -> str:
+        """One line for the console."""
+        return (f"{snapshot['items']} items, {snapshot['bytes_in']} -> "
+                f"{snapshot['bytes_out']} bytes (ratio {snapshot['ratio']:.2f}), "
+                f"{snapshot['throughput_mb_s']:.1f} MB/s, workers {snapshot['utilization']:.0%} "
+                f"busy, {snapshot['cpu_share']:.0%} of it on CPU ({snapshot['bound']}-bound)")
 
 
 
@@ -217,12 +1945,64 @@ async def main():
     with tempfile.TemporaryDirectory() as temp_dir:
         # Create dummy files
         input_files = create_dummy_files(3, temp_dir)
+        output_dir = os.path.join(temp_dir, "compressed")
 
         print(f"Input files: {input_files}")
 
-        # Compress the files in parallel
-        compressed_files = await parallel_compress_files(input_files)
-        print(f"Compressed files: {compressed_files}")
+        # Compress the files in parallel, straight into output_dir
+        metrics_file = os.path.join(temp_dir, "metrics.json")
+        compressed_files = await parallel_compress_files(input_files, output_dir,
+                                                         metrics_file=metrics_file)
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        print(f"Metrics: latency {metrics['latency_histogram']}, queues {metrics['queues']}")
+        print(f"Compressed files: {[r.output_file for r in compressed_files]}")
+        for r in compressed_files:
+            print(f"  {os.path.basename(r.input_file)}: {r.input_bytes} -> {r.output_bytes} bytes "
+                  f"(ratio {r.ratio:.2f}, {r.seconds * 1000:.2f} ms)")
+
+        # Pick a codec for this data from a quick sampling benchmark
+        results = benchmark_codecs(input_files)
+        for r in results:
+            print(f"  {r.codec:<5} level {r.level:>2}: ratio {r.ratio:.2f}, {r.throughput:8.1f} MB/s")
+        best = recommend_codec(results, min_throughput=10.0)
+        if best is not None:
+            print(f"Recommended for >= 10 MB/s: {best.codec} level {best.level}")
+            await parallel_compress_files(input_files, output_dir, level=best.level, codec=best.codec)
+
+        # Incremental runs: the second run only recompresses the modified file
+        incremental_dir = os.path.join(temp_dir, "incremental")
+        await parallel_compress_files(input_files, incremental_dir, incremental=True,
+                                      hash_content=True)
+        os.utime(input_files[0])  # Touched, but the content is unchanged
+        with open(input_files[1], "ab") as f:
+            f.write(b"appended")
+        await parallel_compress_files(input_files, incremental_dir, incremental=True,
+                                      hash_content=True)
+        # Without a manifest the hash is unused: split files are not read a second time
+        split = await parallel_compress_files(input_files[:1], os.path.join(temp_dir, "split"),
+                                              split_threshold=0, block_size=16,
+                                              hash_content=True)
+        assert split[0].content_hash is None
+
+        # Bounded pipeline over a lazily generated stream of files
+        pipeline_dir = os.path.join(temp_dir, "pipelined")
+        stream = (entry.path for entry in os.scandir(temp_dir) if entry.is_file())
+        results, report = await pipelined_compress_files(stream, pipeline_dir,
+                                                         block_size=64 * 1024,
+                                                         max_in_flight_bytes=1024 * 1024)
+        print(f"Pipelined {len(results)} files:")
+        print(report)
+
+        # Restore drill: verify the incremental archives against their manifest
+        archives = [r.output_file for r in await parallel_compress_files(
+            input_files, incremental_dir, incremental=True, hash_content=True)]
+        restored, restore_report = await parallel_decompress_files(
+            archives, verify_only=True, manifest=load_manifest(incremental_dir))
+        for r in restored:
+            print(f"  {os.path.basename(r.archive)}: crc32 {r.crc32:08x}, "
+                  f"{'ok' if r.ok else r.error}")
+        print(restore_report)
 
 
 